@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import threading
+
+from metadatacache import cacheDirectory
+
+cover_max_dimension = 1000
+cover_format = "jpeg"
+cover_quality = 90
+# Covers already within the size limit and smaller than this are embedded
+# without recompressing them
+cover_keep_bytes = 512 * 1024
+
+mime_types = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+def sniffFormat(data):
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    return None
+
+
+class CoverArt:
+    __slots__ = ["data", "format", "path"]
+
+    def __init__(self, data, format, path):
+        self.data = data
+        self.format = format
+        # A file holding exactly `data`, for ffmpeg to read
+        self.path = path
+
+    def mime(self):
+        return mime_types[self.format]
+
+
+class ArtworkCache:
+    # Album covers, loaded, checked and shrunk once and then shared by every
+    # track (and every tagging worker) that uses them
+    def __init__(self, maxDimension=None, format=None, quality=None, directory=None):
+        self.maxDimension = maxDimension if maxDimension is not None else cover_max_dimension
+        self.format = format if format is not None else cover_format
+        self.quality = quality if quality is not None else cover_quality
+        self.__directory = directory
+        self.__covers = {}
+        self.__locks = {}
+        self.__lock = threading.Lock()
+
+    def cover(self, path):
+        # Raises ValueError if the file isn't a PNG or JPEG image
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+        with self.__lock:
+            cover = self.__covers.get(key)
+            if cover is not None:
+                return cover
+            keyLock = self.__locks.setdefault(key, threading.Lock())
+
+        # Only one worker loads a given cover; the rest wait for it
+        with keyLock:
+            with self.__lock:
+                cover = self.__covers.get(key)
+            if cover is None:
+                cover = self.__load(path)
+                with self.__lock:
+                    self.__covers[key] = cover
+                    self.__locks.pop(key, None)
+        return cover
+
+    def clear(self):
+        with self.__lock:
+            self.__covers.clear()
+
+    def __load(self, path):
+        with open(path, "rb") as _file:
+            data = _file.read()
+
+        format = sniffFormat(data)
+        if format is None:
+            raise ValueError(f"{path} isn't a PNG or JPEG image")
+        try:
+            from PIL import Image
+        except ImportError:
+            # Without Pillow covers are still only read once per album, but
+            # they're embedded as they are
+            return CoverArt(data, format, path)
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except OSError as e:
+            raise ValueError(f"{path} isn't a valid image: {e}")
+        if max(image.size) <= self.maxDimension and len(data) <= cover_keep_bytes:
+            return CoverArt(data, format, path)
+
+        image.thumbnail((self.maxDimension, self.maxDimension), Image.LANCZOS)
+        output = io.BytesIO()
+        if self.format == "jpeg":
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(output, "JPEG", quality=self.quality, optimize=True)
+        else:
+            image.save(output, "PNG", optimize=True)
+        data = output.getvalue()
+
+        # ffmpeg reads the cover from disk, so keep the shrunk copy around
+        directory = self.__directory or os.path.join(cacheDirectory(), "artwork")
+        os.makedirs(directory, exist_ok=True)
+        processedPath = os.path.join(directory, hashlib.sha1(data).hexdigest() + "." + ("jpg" if self.format == "jpeg" else "png"))
+        if not os.path.exists(processedPath):
+            temporaryPath = f"{processedPath}.{threading.get_ident()}.tmp"
+            with open(temporaryPath, "wb") as _file:
+                _file.write(data)
+            os.replace(temporaryPath, processedPath)
+        return CoverArt(data, self.format, processedPath)
+
+
+shared_cache = ArtworkCache()
@@ -0,0 +1,113 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from metadatacache import cacheDirectory
+
+audio_cache_max_bytes = 10 * 1024 * 1024 * 1024
+
+# ioctl that makes a copy-on-write clone of a file on btrfs, XFS and friends
+FICLONE = 0x40049409
+
+
+def cloneFile(source, destination):
+    # A reflink copy where the filesystem supports it (instant, no extra
+    # space), otherwise a normal copy. Never a hardlink: the copy gets
+    # tagged in place, which would change every other link too.
+    try:
+        import fcntl
+        with open(source, "rb") as sourceFile, open(destination, "wb") as destinationFile:
+            fcntl.ioctl(destinationFile.fileno(), FICLONE, sourceFile.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(source, destination)
+
+
+class AudioCache:
+    # Finished audio, keyed by video ID and format, shared between albums so
+    # the same video is only downloaded and transcoded once. The least
+    # recently used files are evicted once the cache grows past maxBytes.
+    def __init__(self, directory=None, maxBytes=audio_cache_max_bytes):
+        self.__directory = directory if directory is not None else os.path.join(cacheDirectory(), "audio")
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__path = os.path.join(self.__directory, "index.sqlite")
+        self.__maxBytes = maxBytes
+        self.__lock = threading.Lock()
+
+        with self.__connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS audio (
+                key TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+
+    @contextlib.contextmanager
+    def __connect(self):
+        db = sqlite3.connect(self.__path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def fetch(self, key, destination):
+        # Copies the cached audio for `key` to `destination`; False on a miss
+        with self.__lock, self.__connect() as db:
+            row = db.execute("SELECT file FROM audio WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            cachedPath = os.path.join(self.__directory, row[0])
+            if not os.path.exists(cachedPath):
+                db.execute("DELETE FROM audio WHERE key = ?", (key,))
+                return False
+            db.execute("UPDATE audio SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        temporaryPath = f"{destination}.{threading.get_ident()}.tmp"
+        cloneFile(cachedPath, temporaryPath)
+        os.replace(temporaryPath, destination)
+        return True
+
+    def store(self, key, source):
+        fileName = hashlib.sha1(key.encode("utf-8")).hexdigest() + os.path.splitext(source)[1]
+        cachedPath = os.path.join(self.__directory, fileName)
+
+        # A copy of its own, not a link: the album's file is tagged again
+        # afterwards (ReplayGain, a title change), and none of that should
+        # reach other albums
+        temporaryPath = f"{cachedPath}.{threading.get_ident()}.tmp"
+        cloneFile(source, temporaryPath)
+        os.replace(temporaryPath, cachedPath)
+
+        with self.__lock, self.__connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO audio (key, file, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, fileName, os.path.getsize(cachedPath), time.time())
+            )
+            self.__evict(db)
+
+    def size(self):
+        with self.__lock, self.__connect() as db:
+            return db.execute("SELECT COALESCE(SUM(size), 0) FROM audio").fetchone()[0]
+
+    def clear(self):
+        with self.__lock, self.__connect() as db:
+            for (fileName,) in db.execute("SELECT file FROM audio").fetchall():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.__directory, fileName))
+            db.execute("DELETE FROM audio")
+
+    def __evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM audio").fetchone()[0]
+        for key, fileName, size in db.execute("SELECT key, file, size FROM audio ORDER BY last_used").fetchall():
+            if total <= self.__maxBytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.__directory, fileName))
+            db.execute("DELETE FROM audio WHERE key = ?", (key,))
+            total -= size
@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from scheduler import DownloadScheduler, PostProcessingStage
+from progress import ProgressAggregator
+from trackjob import TrackJob, AlbumTrack, writeAlbumGain
+from manifest import AlbumManifest
+from metrics import RunMetrics
+from artwork import ArtworkCache, cover_max_dimension, cover_format
+from sessions import YoutubeDLPool
+from audiocache import AudioCache, audio_cache_max_bytes
+from loudness import LoudnessAnalyzer, numpyAvailable
+from retry import RetryPolicy, classifyError, isThrottling, download_attempts
+from ratecontrol import TokenBucket, ConcurrencyController
+import segmented
+
+# Runs saved album configurations without the GUI:
+#
+#     python batch.py album1.json album2.json --workers 6 --summary summary.json
+#     python batch.py album.json --trace trace.json --metrics album.prom
+#     python batch.py album.json --adaptive --max-bandwidth 5
+#
+# Tracks from every album share one pool of download slots and one
+# post-processing stage. Downloads that fail on something that might clear
+# up (timeouts, throttling) are retried later without holding up the rest. A
+# JSON summary, including every track that failed for good, is printed when
+# everything is done.
+
+default_download_workers = 3
+slowest_track_count = 5
+
+
+class AlbumRun:
+    def __init__(self, configPath, config):
+        self.configPath = configPath
+        self.config = config
+        self.tracks = [
+            AlbumTrack(
+                trackData,
+                (trackData["index"], len(config["tracks"])),
+                config["album"],
+                config["artist"],
+                config["year"],
+                config["album_art_path"],
+                config.get("title_pattern"),
+            )
+            for trackData in config["tracks"]
+        ]
+
+        self.lock = threading.Lock()
+        self.startTime = None
+        self.endTime = None
+        self.completed = 0
+        self.skipped = 0
+        self.failures = []
+        self.bytesDownloaded = 0
+        self.manifest = None
+        self.jobs = []
+
+    def trackSkipped(self):
+        with self.lock:
+            self.completed += 1
+            self.skipped += 1
+
+    def trackStarted(self):
+        with self.lock:
+            if self.startTime is None:
+                self.startTime = time.monotonic()
+
+    def trackFinished(self, track, error, bytesDownloaded, attempts=1):
+        # True once it was the album's last track
+        with self.lock:
+            self.bytesDownloaded += bytesDownloaded
+            if error is None:
+                self.completed += 1
+            else:
+                self.failures.append({
+                    "index": track.trackIndex()[0],
+                    "title": track.title(),
+                    "url": track.url(),
+                    "error": str(error),
+                    "kind": classifyError(error),
+                    "attempts": attempts,
+                })
+            if self.completed + len(self.failures) == len(self.tracks):
+                self.endTime = time.monotonic()
+                return True
+            return False
+
+    def summary(self):
+        elapsed = None
+        if self.startTime is not None:
+            elapsed = (self.endTime if self.endTime is not None else time.monotonic()) - self.startTime
+        return {
+            "config": self.configPath,
+            "album": self.config["album"],
+            "tracks": len(self.tracks),
+            "completed": self.completed,
+            "skipped": self.skipped,
+            "failed": sorted(self.failures, key=lambda failure: failure["index"]),
+            "bytes_downloaded": self.bytesDownloaded,
+            "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+        }
+
+
+class BatchRunner:
+    def __init__(self, downloadWorkers=default_download_workers, processingWorkers=None, quiet=False, artworkCache=None, audioCache=None, replayGain=False, loudness=None, retryPolicy=None, adaptive=False, maxBandwidth=None):
+        self.__quiet = quiet
+        self.__retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+        self.__artworkCache = artworkCache if artworkCache is not None else ArtworkCache()
+        self.__audioCache = audioCache
+        # Albums can also ask for it in their config
+        self.__replayGain = replayGain
+        self.__loudness = loudness if loudness is not None else LoudnessAnalyzer()
+        self.sessions = YoutubeDLPool()
+        self.metrics = RunMetrics()
+        self.__progress = ProgressAggregator()
+        self.__scheduler = DownloadScheduler(self.__startDownload, downloadWorkers)
+        self.__stage = PostProcessingStage(self.__postProcess, processingWorkers)
+        # maxBandwidth is in bytes per second, shared by every download
+        self.bandwidth = TokenBucket(maxBandwidth) if maxBandwidth else None
+        self.__controller = ConcurrencyController(self.__setDownloadWorkers, downloadWorkers, bandwidth=self.bandwidth) if adaptive else None
+
+        self.__albums = {}
+        self.__priorities = {}
+        self.__remaining = 0
+        self.__lock = threading.Lock()
+        self.__allDone = threading.Event()
+
+    def run(self, albums):
+        startTime = time.monotonic()
+
+        priority = 0
+        for album in albums:
+            os.makedirs(album.config["album"], exist_ok=True)
+            album.manifest = AlbumManifest(album.config["album"])
+            loudness = None
+            if self.__replayGain or album.config.get("replaygain", False):
+                if numpyAvailable():
+                    loudness = self.__loudness
+                else:
+                    print(f"NumPy isn't installed, so {album.config['album']} won't get ReplayGain tags", file=sys.stderr)
+
+            skippedJobs = []
+            for track in album.tracks:
+                job = TrackJob(track, manifest=album.manifest, metrics=self.metrics, preferStreamCopy=album.config.get("prefer_stream_copy", False), artworkCache=self.__artworkCache, sessions=self.sessions, connections=album.config.get("connections_per_track", segmented.default_connections), audioCache=self.__audioCache, loudness=loudness, bandwidth=self.bandwidth)
+                if loudness is not None:
+                    album.jobs.append(job)
+                if job.resumeState() == AlbumManifest.COMPLETE:
+                    album.trackSkipped()
+                    skippedJobs.append(job)
+                    continue
+
+                job.progressHook = lambda d, job=job: self.__progress.report(job, d)
+                self.__albums[job] = album
+                self.__priorities[job] = priority
+                self.__remaining += 1
+                self.metrics.setLabel(track, f"{track.album()} / {track.trackIndex()[0]}. {track.title()}")
+                self.metrics.begin(track, "queue_wait")
+                self.__scheduler.enqueue(job, priority)
+                priority += 1
+
+            # Finished tracks still count towards the album gain if anything
+            # else in the album is being redone, so get them measured early
+            if loudness is not None and album.skipped < len(album.tracks):
+                for job in skippedJobs:
+                    job.analyzeLoudness()
+
+        if self.__remaining > 0:
+            self.__scheduler.start()
+            if self.__controller is not None:
+                threading.Thread(target=self.__adaptConcurrency, daemon=True).start()
+            self.__allDone.wait()
+        self.__stage.shutdown()
+        self.sessions.close()
+        self.__loudness.shutdown()
+
+        failures = [(album, failure) for album in albums for failure in album.failures]
+        if failures and not self.__quiet:
+            print(f"{len(failures)} track(s) failed:", file=sys.stderr)
+            for album, failure in failures:
+                print(f"    {album.config['album']} / {failure['index']}. {failure['title']} ({failure['kind']}, {failure['attempts']} attempt(s)): {failure['error']}", file=sys.stderr)
+
+        return {
+            "albums": [album.summary() for album in albums],
+            "elapsed_seconds": round(time.monotonic() - startTime, 3),
+            "failed_tracks": len(failures),
+            "download_workers": self.__scheduler.maxWorkers(),
+            "slowest_tracks": [
+                { "track": label, "seconds": round(total, 3), "stages": { stage: round(seconds, 3) for stage, seconds in stages.items() } }
+                for label, total, stages, _ in self.metrics.slowestTracks()[:slowest_track_count]
+            ],
+        }
+
+    def __startDownload(self, job):
+        threading.Thread(target=self.__download, args=(job,), daemon=True).start()
+
+    def __download(self, job):
+        self.__albums[job].trackStarted()
+        try:
+            job.download()
+        except Exception as e:
+            if self.__controller is not None and isThrottling(e):
+                self.__controller.throttled()
+            delay = self.__retryPolicy.retryDelay(job.attempts, e)
+            if delay is not None:
+                self.__retryLater(job, delay)
+                return
+            self.__trackFinished(job, e)
+            self.__scheduler.jobFinished(job)
+            return
+
+        self.__stage.submit(job)
+        self.__scheduler.jobFinished(job)
+
+    def __adaptConcurrency(self):
+        while not self.__allDone.wait(1.0):
+            self.__controller.tick(self.__progress.overall()[2], self.__progress.activeRates(), self.__scheduler.inFlightCount())
+
+    def __setDownloadWorkers(self, count):
+        self.metrics.count("concurrency_changes")
+        if not self.__quiet:
+            print(f"[downloads] {count} at once", file=sys.stderr)
+        self.__scheduler.setMaxWorkers(count)
+
+    def __retryLater(self, job, delay):
+        # The track gives up its download slot while it waits, and then
+        # goes back into the queue where it was
+        self.metrics.count("download_retries")
+        job.beginStage("queue_wait")
+        self.__scheduler.park(job)
+        timer = threading.Timer(delay, self.__scheduler.unpark, args=(job, self.__priorities[job]))
+        timer.daemon = True
+        timer.start()
+
+    def __postProcess(self, job):
+        try:
+            job.postProcess()
+        except Exception as e:
+            self.__trackFinished(job, e)
+            return
+        self.__trackFinished(job, None)
+
+    def __trackFinished(self, job, error):
+        track = job.track
+        album = self.__albums[job]
+        if album.trackFinished(track, error, self.__progress.downloadedBytes(job), job.attempts) and album.jobs:
+            try:
+                with self.metrics.runSpan("replaygain"):
+                    writeAlbumGain(album.jobs)
+            except Exception as e:
+                print(f"Couldn't write ReplayGain tags for {track.album()}: {e}", file=sys.stderr)
+        if not self.__quiet:
+            status = "ok" if error is None else f"failed: {error}"
+            print(f"[{status}] {track.album()} / {track.title()}", file=sys.stderr)
+
+        with self.__lock:
+            self.__remaining -= 1
+            if self.__remaining == 0:
+                self.__allDone.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download and tag albums from saved configuration files.")
+    parser.add_argument("configs", nargs="+", help="configuration files saved from the GUI")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of simultaneous downloads")
+    parser.add_argument("-p", "--processing-workers", type=int, default=None, help="number of simultaneous transcodes (default: one per core)")
+    parser.add_argument("-s", "--summary", default=None, help="also write the JSON summary to this file")
+    parser.add_argument("--cover-size", type=int, default=cover_max_dimension, help=f"shrink cover art to at most this many pixels across (default: {cover_max_dimension})")
+    parser.add_argument("--cover-format", choices=["jpeg", "png"], default=cover_format, help=f"format to recompress large cover art to (default: {cover_format})")
+    parser.add_argument("--audio-cache-size", type=int, default=audio_cache_max_bytes // (1024 * 1024), help="size limit of the cache of downloaded audio shared between albums, in MB; 0 turns it off")
+    parser.add_argument("--replaygain", action="store_true", help="measure loudness and write ReplayGain track and album gain tags (needs NumPy)")
+    parser.add_argument("--attempts", type=int, default=download_attempts, help=f"times to try each download when it fails on a network error (default: {download_attempts})")
+    parser.add_argument("--adaptive", action="store_true", help="adjust the number of simultaneous downloads to what YouTube and the connection allow, starting from --workers")
+    parser.add_argument("--max-bandwidth", type=float, default=None, help="limit all downloads together to this many MB/s")
+    parser.add_argument("--trace", default=None, help="write per-track stage timings as JSON to this file")
+    parser.add_argument("--metrics", default=None, help="write Prometheus text-format metrics to this file")
+    args = parser.parse_args(argv)
+
+    albums = []
+    for configPath in args.configs:
+        with open(configPath, "r") as _file:
+            albums.append(AlbumRun(configPath, json.load(_file)))
+
+    workers = args.workers
+    if workers is None:
+        workers = max((album.config.get("max_concurrent_downloads", default_download_workers) for album in albums), default=default_download_workers)
+
+    audioCache = AudioCache(maxBytes=args.audio_cache_size * 1024 * 1024) if args.audio_cache_size > 0 else None
+    runner = BatchRunner(workers, args.processing_workers, artworkCache=ArtworkCache(args.cover_size, args.cover_format), audioCache=audioCache, replayGain=args.replaygain, retryPolicy=RetryPolicy(args.attempts), adaptive=args.adaptive, maxBandwidth=args.max_bandwidth * 1024 * 1024 if args.max_bandwidth else None)
+    summary = runner.run(albums)
+
+    output = json.dumps(summary, indent=4)
+    print(output)
+    if args.summary:
+        with open(args.summary, "w") as _file:
+            _file.write(output)
+    if args.trace:
+        runner.metrics.writeTrace(args.trace)
+    if args.metrics:
+        runner.metrics.writePrometheus(args.metrics)
+
+    return 0 if all(not album["failed"] for album in summary["albums"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import http.server
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import threading
+import time
+import types
+import zlib
+
+# A stand-in for youtube_dl that never touches the network. Playlists are
+# synthetic ("fake://playlist/<count>") and downloads are generated M4A files,
+# served from memory or from a local HTTP server.
+
+track_bytes = 256 * 1024
+chunk_bytes = 16 * 1024
+http_base_url = None
+# Per-connection speed limit of the local HTTP server, in bytes per second,
+# like the throttling YouTube applies to each stream; None for no limit
+http_throttle = None
+
+# Container the fake "bestaudio" comes in: "m4a" (AAC, nothing to transcode)
+# or "webm" (stands in for Opus, which has to be transcoded)
+source_format = "m4a"
+
+# New videos listed ahead of every fake playlist's own, as if they'd just
+# been added to the top of it
+playlist_prepended = 0
+
+# Side of the square cover art the benchmarks tag with, in pixels
+cover_pixels = 600
+
+__audio = {}
+
+
+def atom(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def makeM4A(payloadSize):
+    # Smallest M4A that mutagen will open and tag: one AAC track whose only
+    # sample is `payloadSize` bytes of filler in mdat
+    def moov(mdatOffset):
+        identity = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+        mvhd = atom(b"mvhd", struct.pack(">IIIII", 0, 0, 0, 1000, 1000) + struct.pack(">IH", 0x10000, 0x100) + bytes(10) + identity + bytes(24) + struct.pack(">I", 2))
+        tkhd = atom(b"tkhd", struct.pack(">IIIIII", 7, 0, 0, 1, 0, 1000) + bytes(8) + struct.pack(">HHHH", 0, 0, 0x100, 0) + identity + struct.pack(">II", 0, 0))
+        mdhd = atom(b"mdhd", struct.pack(">IIIIIHH", 0, 0, 0, 44100, 44100, 0x55c4, 0))
+        hdlr = atom(b"hdlr", struct.pack(">II", 0, 0) + b"soun" + bytes(12) + b"SoundHandler\0")
+        decoderConfig = b"\x40\x15" + bytes(3) + struct.pack(">II", 128000, 128000) + b"\x05\x02\x12\x10"
+        esDescriptor = bytes(3) + b"\x04" + bytes([len(decoderConfig)]) + decoderConfig + b"\x06\x01\x02"
+        esds = atom(b"esds", bytes(4) + b"\x03" + bytes([len(esDescriptor)]) + esDescriptor)
+        mp4a = atom(b"mp4a", bytes(6) + struct.pack(">HHHIHHHHI", 1, 0, 0, 0, 2, 16, 0, 0, 44100 << 16) + esds)
+        stbl = atom(b"stbl",
+            atom(b"stsd", struct.pack(">II", 0, 1) + mp4a)
+            + atom(b"stts", struct.pack(">IIII", 0, 1, 1, 44100))
+            + atom(b"stsc", struct.pack(">IIIII", 0, 1, 1, 1, 1))
+            + atom(b"stsz", struct.pack(">IIII", 0, 0, 1, payloadSize))
+            + atom(b"stco", struct.pack(">III", 0, 1, mdatOffset))
+        )
+        dinf = atom(b"dinf", atom(b"dref", struct.pack(">II", 0, 1) + atom(b"url ", struct.pack(">I", 1))))
+        minf = atom(b"minf", atom(b"smhd", bytes(8)) + dinf + stbl)
+        return atom(b"moov", mvhd + atom(b"trak", tkhd + atom(b"mdia", mdhd + hdlr + minf)))
+
+    ftyp = atom(b"ftyp", b"M4A " + struct.pack(">I", 0) + b"M4A mp42isom")
+    mdatOffset = len(ftyp) + len(moov(0)) + 8
+    return ftyp + moov(mdatOffset) + atom(b"mdat", bytes(payloadSize))
+
+
+def makeMP3(payloadSize):
+    # An empty ID3v2.4 tag followed by silent 128 kbps MPEG-1 layer 3 frames
+    frame = b"\xff\xfb\x90\x64" + bytes(413)
+    return b"ID3\x04\x00\x00\x00\x00\x00\x00" + frame * max(1, payloadSize // len(frame))
+
+
+def makePNG(width, height, seed=0):
+    # Noisy RGB image, so it compresses about as badly as scanned artwork
+    generator = random.Random(seed)
+    rows = b"".join(b"\0" + generator.randbytes(width * 3) for _ in range(height))
+    def chunk(kind, payload):
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+    return (b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b""))
+
+
+def audioFor(videoId):
+    data = __audio.get(track_bytes)
+    if data is None:
+        data = __audio[track_bytes] = makeM4A(track_bytes)
+    return data
+
+
+def videoInfo(videoId, ext=None):
+    ext = ext or source_format
+    return {
+        "id": videoId,
+        "title": f"Track {videoId} [OST] - Composer",
+        "duration": 180,
+        "webpage_url": f"fake://video/{videoId}",
+        "ext": ext,
+        "acodec": "mp4a.40.2" if ext == "m4a" else "opus",
+        "filesize": len(audioFor(videoId)),
+        "url": f"{http_base_url}/{videoId}.m4a" if http_base_url else f"fake://media/{videoId}.m4a",
+        # Roughly what a real YouTube result carries that we don't use
+        "formats": [
+            {"format_id": str(formatId), "url": f"fake://media/{videoId}.{formatId}?" + "x" * 400, "ext": ext, "filesize": 1000000 + formatId, "tbr": 128.0, "http_headers": {"User-Agent": "fake"}}
+            for formatId in range(20)
+        ],
+        "thumbnails": [{"url": f"fake://thumbnail/{videoId}/{size}.jpg", "width": size, "height": size} for size in (120, 320, 480, 640, 1280)],
+        "description": "Description " * 100,
+        "tags": ["soundtrack", "ost", "game"] * 5,
+    }
+
+
+class DownloadError(Exception):
+    pass
+
+
+class YoutubeDL:
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        self._progress_hooks = list(self.params.get("progress_hooks", []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def add_progress_hook(self, hook):
+        self._progress_hooks.append(hook)
+
+    def extract_info(self, url, download=True, ie_key=None, process=True, **kwargs):
+        if url.startswith("fake://playlist/"):
+            count = int(url.rsplit("/", 1)[1])
+            videoIds = [f"n{i:05}" for i in range(playlist_prepended)] + [f"v{i:05}" for i in range(count)]
+            entries = (
+                {"_type": "url", "ie_key": "Fake", "id": videoId, "url": videoId, "title": f"Track {videoId} [OST] - Composer"}
+                for videoId in videoIds
+            )
+            return {"_type": "playlist", "id": url, "title": "Playlist", "entries": entries if not process else list(entries)}
+
+        videoId = url.rsplit("/", 1)[-1]
+        info = videoInfo(videoId, "m4a" if "acodec^=mp4a" in self.params.get("format", "") else None)
+        if download:
+            self.process_info(info)
+        return info
+
+    def process_info(self, info):
+        if self.in_download_archive(info):
+            return
+        self.__download(info)
+        self.record_download_archive(info)
+
+    def in_download_archive(self, info):
+        archive = self.params.get("download_archive")
+        if not archive or not os.path.exists(archive):
+            return False
+        with open(archive) as _file:
+            return f"fake {info['id']}" in (line.strip() for line in _file)
+
+    def record_download_archive(self, info):
+        archive = self.params.get("download_archive")
+        if archive:
+            with open(archive, "a") as _file:
+                _file.write(f"fake {info['id']}\n")
+
+    def get_info_extractor(self, ie_key):
+        return None
+
+    def prepare_filename(self, info):
+        template = self.params.get("outtmpl", "%(title)s.%(ext)s")
+        return template.replace("%(ext)s", info["ext"]).replace("%(title)s", info["title"]).replace("%(id)s", info["id"]).replace("%%", "%")
+
+    def __download(self, info):
+        path = self.prepare_filename(info)
+        if http_base_url:
+            from urllib.request import urlopen
+            source = urlopen(info["url"])
+        else:
+            source = io.BytesIO(audioFor(info["id"]))
+
+        total = info["filesize"]
+        downloaded = 0
+        with source, open(path, "wb") as output:
+            while True:
+                chunk = source.read(chunk_bytes)
+                if not chunk:
+                    break
+                output.write(chunk)
+                downloaded += len(chunk)
+                self.__report({"status": "downloading", "downloaded_bytes": downloaded, "total_bytes": total, "filename": path})
+        self.__report({"status": "finished", "downloaded_bytes": downloaded, "total_bytes": total, "filename": path})
+
+    def __report(self, d):
+        for hook in self._progress_hooks:
+            hook(d)
+
+
+ffmpeg_mp4_tags = {
+    "title": "\xa9nam",
+    "album": "\xa9alb",
+    "artist": "\xa9ART",
+    "album_artist": "aART",
+    "composer": "\xa9wrt",
+    "date": "\xa9day",
+}
+
+
+class FFmpegPostProcessor:
+    def __init__(self, downloader=None):
+        self._downloader = downloader
+
+    def run_ffmpeg(self, path, out_path, opts):
+        shutil.copyfile(path, out_path)
+
+    def run_ffmpeg_multiple_files(self, input_paths, out_path, opts):
+        # Like ffmpeg, writes the output once with any -metadata tags and
+        # cover art already in it
+        with open(input_paths[0], "rb") as source:
+            data = io.BytesIO(source.read())
+
+        metadata = dict(opts[i + 1].split("=", 1) for i, option in enumerate(opts) if option == "-metadata")
+        if metadata or len(input_paths) > 1:
+            from mutagen.mp4 import MP4, MP4Cover
+            audio = MP4(data)
+            if audio.tags is None:
+                audio.add_tags()
+            for key, value in metadata.items():
+                if key == "track":
+                    index, _, count = value.partition("/")
+                    audio.tags["trkn"] = [(int(index), int(count or 0))]
+                else:
+                    audio.tags[ffmpeg_mp4_tags[key]] = value
+            if len(input_paths) > 1:
+                with open(input_paths[1], "rb") as cover:
+                    image = cover.read()
+                    audio.tags["covr"] = [MP4Cover(image, MP4Cover.FORMAT_JPEG if image.startswith(b"\xff\xd8") else MP4Cover.FORMAT_PNG)]
+            data.seek(0)
+            audio.save(data)
+
+        with open(out_path, "wb") as output:
+            output.write(data.getvalue())
+
+
+class FFmpegExtractAudioPP(FFmpegPostProcessor):
+    # "Transcodes" by copying the download to its .m4a name
+    def __init__(self, downloader=None, preferredcodec=None, preferredquality=None, nopostoverwrites=False):
+        super().__init__(downloader)
+
+    def run(self, information):
+        path = information["filepath"]
+        newPath = path.rpartition(".")[0] + ".m4a"
+        if newPath != path:
+            shutil.copyfile(path, newPath)
+        information["filepath"] = newPath
+        information["ext"] = "m4a"
+        return [path], information
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Serves generated audio as /<video id>.m4a, honouring Range requests
+    def do_GET(self):
+        data = audioFor(self.path.strip("/").rsplit(".", 1)[0])
+        start, end = 0, len(data) - 1
+
+        requestedRange = self.headers.get("Range")
+        if requestedRange and requestedRange.startswith("bytes="):
+            first, _, last = requestedRange[len("bytes="):].partition("-")
+            start = int(first) if first else 0
+            end = min(int(last), end) if last else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "audio/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if http_throttle is None:
+            self.wfile.write(data[start:end + 1])
+            return
+
+        sent = start
+        began = time.monotonic()
+        while sent <= end:
+            self.wfile.write(data[sent:min(sent + chunk_bytes, end + 1)])
+            sent += chunk_bytes
+            delay = (sent - start) / http_throttle - (time.monotonic() - began)
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startServer():
+    global http_base_url
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+def install():
+    # Must run before anything imports youtube_dl
+    module = types.ModuleType("youtube_dl")
+    module.YoutubeDL = YoutubeDL
+    module.__path__ = []
+
+    postprocessor = types.ModuleType("youtube_dl.postprocessor")
+    postprocessor.FFmpegExtractAudioPP = FFmpegExtractAudioPP
+    postprocessor.FFmpegPostProcessor = FFmpegPostProcessor
+    module.postprocessor = postprocessor
+
+    utils = types.ModuleType("youtube_dl.utils")
+    utils.DownloadError = DownloadError
+    module.utils = utils
+
+    sys.modules["youtube_dl"] = module
+    sys.modules["youtube_dl.postprocessor"] = postprocessor
+    sys.modules["youtube_dl.utils"] = utils
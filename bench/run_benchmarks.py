@@ -0,0 +1,485 @@
+import argparse
+import contextlib
+import gc
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Offline benchmarks for the main stages of an album run. youtube_dl is
+# replaced by bench/fakeyoutubedl.py, so nothing here goes to YouTube:
+#
+#     python bench/run_benchmarks.py --sizes 10 100 1000 --output before.json
+#
+# Stages whose dependencies (PyQt5, mutagen) aren't installed are reported as
+# skipped rather than failing the whole run.
+
+benchDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchDirectory)
+sys.path.insert(1, os.path.dirname(benchDirectory))
+
+import fakeyoutubedl
+fakeyoutubedl.install()
+
+import segmented
+
+default_sizes = [10, 100, 1000, 10000]
+# Stages that don't depend on playlist size, and so only run once
+unsized_stages = {"startup"}
+startup_budget_seconds = 1.5
+connections_per_track = 1
+# Length of the decoded audio each track in the loudness stage stands for
+loudness_track_seconds = 10
+
+
+class Skipped(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def workingDirectory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def bytesWritten():
+    # Bytes this process has passed to write() so far (Linux only)
+    try:
+        with open("/proc/self/io") as _file:
+            for line in _file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def measured():
+    # Times the block, and counts the bytes written during it where we can
+    result = {}
+    written = bytesWritten()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result["seconds"] = time.perf_counter() - start
+        if written is not None:
+            result["bytes_written"] = bytesWritten() - written
+
+
+def requireQt():
+    try:
+        from PyQt5 import QtWidgets
+    except ImportError as e:
+        raise Skipped(f"PyQt5 not installed ({e})")
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    import downloadinator
+    return app, downloadinator
+
+
+def requireMutagen():
+    if importlib.util.find_spec("mutagen") is None:
+        raise Skipped("mutagen not installed")
+
+
+def writeCover(scratch):
+    path = os.path.join(scratch, "cover.png")
+    if not os.path.exists(path):
+        with open(path, "wb") as cover:
+            cover.write(fakeyoutubedl.makePNG(fakeyoutubedl.cover_pixels, fakeyoutubedl.cover_pixels))
+    return path
+
+
+def fakeEntries(count):
+    return [fakeyoutubedl.videoInfo(f"v{i:05}") | {"index": i + 1} for i in range(count)]
+
+
+def benchMetadata(count, scratch):
+    _, downloadinator = requireQt()
+    from metadatacache import PlaylistMetadataCache
+
+    cache = PlaylistMetadataCache(os.path.join(scratch, f"metadata-{count}.sqlite"))
+    results = []
+    thread = downloadinator.PlaylistMetadataDownloaderThread(None, f"fake://playlist/{count}", cache)
+    thread.complete.connect(results.append)
+    thread.error.connect(lambda e: results.append(e))
+
+    with measured() as measurement:
+        thread.run()
+
+    if not results or isinstance(results[0], Exception) or len(results[0]) != count:
+        raise RuntimeError(f"expected {count} entries, got {results!r:.200}")
+    checkCachedReorder(count, scratch, downloadinator)
+    return measurement
+
+
+def fetchPlaylist(downloadinator, url, cache):
+    results = []
+    thread = downloadinator.PlaylistMetadataDownloaderThread(None, url, cache)
+    thread.complete.connect(results.append)
+    thread.error.connect(results.append)
+    thread.run()
+    if not results or isinstance(results[0], Exception):
+        raise RuntimeError(f"fetching {url} failed: {results!r:.200}")
+    return [(entry["id"], entry["index"]) for entry in results[0]]
+
+
+def checkCachedReorder(count, scratch, downloadinator):
+    # After videos are added to the top of a playlist, the listing that's
+    # served from the cache has to number the tracks the same as a fresh one
+    from metadatacache import PlaylistMetadataCache
+
+    path = os.path.join(scratch, f"metadata-reorder-{count}.sqlite")
+    url = f"fake://playlist/{count}"
+    fetchPlaylist(downloadinator, url, PlaylistMetadataCache(path))
+    fakeyoutubedl.playlist_prepended = 1
+    try:
+        fresh = fetchPlaylist(downloadinator, url, PlaylistMetadataCache(path, listingTTL=0))
+        cached = fetchPlaylist(downloadinator, url, PlaylistMetadataCache(path))
+    finally:
+        fakeyoutubedl.playlist_prepended = 0
+    if cached != fresh:
+        raise RuntimeError(f"cached playlist differs from the fresh one after a reorder: {cached[:3]} vs {fresh[:3]}")
+
+
+def benchTrackItems(count, scratch):
+    _, downloadinator = requireQt()
+    entries = fakeEntries(count)
+
+    with measured() as measurement:
+        tracks = [downloadinator.TrackItem(None, entry, (entry["index"], count)) for entry in entries]
+
+    del tracks
+    return measurement
+
+
+def benchPopulate(count, scratch):
+    _, downloadinator = requireQt()
+    window = downloadinator.MyWindow()
+    window.track_list = [downloadinator.TrackItem(window, entry, (entry["index"], count)) for entry in fakeEntries(count)]
+
+    with measured() as measurement:
+        window.updatePreview()
+
+    window.deleteLater()
+    return measurement
+
+
+def tagJobs(count, scratch, extension, makeFile):
+    from trackjob import TrackJob, AlbumTrack
+
+    writeCover(scratch)
+
+    album = os.path.join(scratch, f"tagging-{extension}-{count}")
+    os.makedirs(album, exist_ok=True)
+    data = makeFile(fakeyoutubedl.track_bytes)
+
+    jobs = []
+    for entry in fakeEntries(count):
+        track = AlbumTrack(entry, (entry["index"], count), album, "Artist", "2016", os.path.join(scratch, "cover.png"))
+        job = TrackJob(track)
+        with open(job.outputPath(extension), "wb") as output:
+            output.write(data)
+        jobs.append(job)
+    return jobs
+
+
+def benchTagM4A(count, scratch):
+    requireMutagen()
+    jobs = tagJobs(count, scratch, "m4a", fakeyoutubedl.makeM4A)
+
+    with measured() as measurement:
+        for job in jobs:
+            job.setM4AMetadata()
+    return measurement
+
+
+def benchRetagM4A(count, scratch):
+    # Tagging an already-tagged file, e.g. after the title rules change; with
+    # padding reserved the first time round this shouldn't move any audio
+    requireMutagen()
+    jobs = tagJobs(count, scratch, "m4a", fakeyoutubedl.makeM4A)
+    for job in jobs:
+        job.setM4AMetadata()
+
+    with measured() as measurement:
+        for job in jobs:
+            job.setM4AMetadata()
+    return measurement
+
+
+def benchTagMP3(count, scratch):
+    requireMutagen()
+    jobs = tagJobs(count, scratch, "mp3", fakeyoutubedl.makeMP3)
+
+    with measured() as measurement:
+        for job in jobs:
+            job.setMP3Metadata()
+    return measurement
+
+
+def benchEndToEnd(count, scratch):
+    requireMutagen()
+    from batch import AlbumRun, BatchRunner
+
+    writeCover(scratch)
+
+    config = {
+        "playlist_url": f"fake://playlist/{count}",
+        "title_pattern": "s/\\s*\\[OST\\]//\n^(.*)[\\s*]-",
+        "artist": "Artist",
+        "album": f"end-to-end-{count}",
+        "year": "2016",
+        "album_art_path": "cover.png",
+        "tracks": fakeEntries(count),
+        "connections_per_track": connections_per_track,
+    }
+
+    with workingDirectory(scratch):
+        with measured() as measurement:
+            summary = BatchRunner(8, quiet=True).run([AlbumRun("benchmark", config)])
+
+    failed = summary["albums"][0]["failed"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} tracks failed, first: {failed[0]}")
+    return measurement
+
+
+def benchLoudness(count, scratch):
+    if importlib.util.find_spec("numpy") is None:
+        raise Skipped("NumPy not installed")
+    import numpy as np
+    from loudness import LoudnessAnalyzer, analysis_rate, analysis_channels
+
+    # One file of raw PCM, "decoded" by cat, so this measures the analysis
+    # rather than ffmpeg
+    path = os.path.join(scratch, "loudness.f32")
+    frames = loudness_track_seconds * analysis_rate
+    if not os.path.exists(path) or os.path.getsize(path) != frames * analysis_channels * 4:
+        noise = np.random.default_rng(0).normal(0, 0.1, (frames, analysis_channels)).astype("<f4")
+        with open(path, "wb") as _file:
+            _file.write(noise.tobytes())
+
+    analyzer = LoudnessAnalyzer(command=["cat", "{path}"])
+    with measured() as measurement:
+        futures = [analyzer.submit(path) for _ in range(count)]
+        for future in futures:
+            future.result()
+    analyzer.shutdown()
+    measurement["audio_seconds_per_second"] = round(count * loudness_track_seconds / measurement["seconds"], 1)
+    return measurement
+
+
+def peakRSS():
+    # In bytes; ru_maxrss is in kilobytes on Linux but bytes on macOS
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Run in a fresh interpreter with the real youtube_dl (if it's installed), up
+# to the point the window has been shown and painted
+startup_probe = '''
+import json, os, sys, time
+start = time.perf_counter()
+from PyQt5 import QtWidgets
+app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+import downloadinator
+imported = time.perf_counter()
+window = downloadinator.MyWindow()
+window.show()
+deferred = [module for module in ("youtube_dl", "mutagen", "PIL") if module not in sys.modules]
+app.processEvents()
+shown = time.perf_counter()
+print(json.dumps({"import": imported - start, "shown": shown - start, "deferred": deferred}))
+os._exit(0)
+'''
+
+
+def benchStartup(count, scratch):
+    requireQt()
+    output = subprocess.run(
+        [sys.executable, "-c", startup_probe],
+        cwd=os.path.dirname(benchDirectory), env=dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen")),
+        check=True, capture_output=True, text=True,
+    ).stdout
+    probe = json.loads(output.strip().splitlines()[-1])
+
+    if probe["shown"] > startup_budget_seconds:
+        raise RuntimeError(f"window took {probe['shown']:.3f}s to show, over the {startup_budget_seconds}s budget")
+    for module in ("youtube_dl", "mutagen"):
+        if module not in probe["deferred"]:
+            raise RuntimeError(f"{module} was imported before the window was shown")
+    return {
+        "seconds": probe["shown"],
+        "import_seconds": probe["import"],
+        "deferred_imports": probe["deferred"],
+    }
+
+
+def memoryProbe(count, scratch):
+    # Runs in a fresh process per playlist size, since peak RSS only goes up
+    app, downloadinator = requireQt()
+    from metadatacache import PlaylistMetadataCache
+
+    window = downloadinator.MyWindow()
+    cache = PlaylistMetadataCache(os.path.join(scratch, f"memory-{count}.sqlite"))
+    gc.collect()
+    baseline = peakRSS()
+
+    thread = downloadinator.PlaylistMetadataDownloaderThread(window, f"fake://playlist/{count}", cache)
+    thread.entriesReady.connect(window.trackListDownloaded)
+    thread.complete.connect(window.trackListComplete)
+    thread.run()
+    # Batches emitted from resolver threads are queued for this one
+    app.processEvents()
+
+    if len(window.track_list) != count:
+        raise RuntimeError(f"expected {count} tracks, got {len(window.track_list)}")
+    print(json.dumps({"baseline_rss": baseline, "peak_rss": peakRSS()}))
+
+
+def benchMemory(count, scratch):
+    if importlib.util.find_spec("resource") is None:
+        raise Skipped("no resource module on this platform")
+    requireQt()
+
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--memory-probe", str(count), "--scratch", scratch],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    elapsed = time.perf_counter() - start
+
+    probe = json.loads(output.strip().splitlines()[-1])
+    growth = probe["peak_rss"] - probe["baseline_rss"]
+    return {
+        "seconds": elapsed,
+        "peak_rss_bytes": probe["peak_rss"],
+        "rss_growth_bytes": growth,
+        "rss_per_track_bytes": growth // count,
+    }
+
+
+stages = {
+    "metadata": benchMetadata,
+    "track_items": benchTrackItems,
+    "populate_queue": benchPopulate,
+    "tag_m4a": benchTagM4A,
+    "retag_m4a": benchRetagM4A,
+    "tag_mp3": benchTagMP3,
+    "end_to_end": benchEndToEnd,
+    "loudness": benchLoudness,
+    "memory": benchMemory,
+    "startup": benchStartup,
+}
+
+
+def runStage(name, count, scratch):
+    try:
+        measurement = stages[name](count, scratch)
+    except Skipped as e:
+        return {"status": "skipped", "reason": str(e)}
+    except Exception as e:
+        return {"status": "failed", "reason": f"{type(e).__name__}: {e}"}
+
+    elapsed = measurement["seconds"]
+    result = {
+        "status": "ok",
+        "seconds": round(elapsed, 6),
+        "per_item_ms": round(elapsed * 1000 / count, 4),
+        "items_per_second": round(count / elapsed, 1) if elapsed > 0 else None,
+    }
+    if "bytes_written" in measurement:
+        result["bytes_written"] = measurement["bytes_written"]
+        result["bytes_written_per_item"] = measurement["bytes_written"] // count
+    result.update((key, value) for key, value in measurement.items() if key not in ("seconds", "bytes_written"))
+    return result
+
+
+def describe(result):
+    details = [f"{result['per_item_ms']:.3f} ms/item"]
+    if "bytes_written_per_item" in result:
+        details.append(f"{result['bytes_written_per_item']} bytes written/item")
+    if "audio_seconds_per_second" in result:
+        details.append(f"{result['audio_seconds_per_second']:.0f}x realtime")
+    if "peak_rss_bytes" in result:
+        details.append(f"peak RSS {result['peak_rss_bytes'] / 1e6:.1f} MB, {result['rss_per_track_bytes']} bytes/track")
+    return f"{result['seconds']:.3f}s ({', '.join(details)})"
+
+
+def main(argv=None):
+    global connections_per_track, startup_budget_seconds
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes, help="playlist sizes to run each stage at")
+    parser.add_argument("--stages", nargs="+", choices=sorted(stages), default=list(stages), help="stages to run")
+    parser.add_argument("--track-bytes", type=int, default=fakeyoutubedl.track_bytes, help="size of each generated track")
+    parser.add_argument("--source-format", choices=["m4a", "webm"], default=fakeyoutubedl.source_format, help="container of the fake downloads; webm has to be transcoded")
+    parser.add_argument("--cover-pixels", type=int, default=fakeyoutubedl.cover_pixels, help="width and height of the generated cover art")
+    parser.add_argument("--throttle", type=int, default=None, help="with --http, limit each connection to this many bytes per second")
+    parser.add_argument("--connections", type=int, default=connections_per_track, help="connections per track for segmented downloads (1 turns them off)")
+    parser.add_argument("--segment-threshold", type=int, default=segmented.segmented_threshold_bytes, help="smallest track, in bytes, to download in segments")
+    parser.add_argument("--http", action="store_true", help="serve generated audio from a local HTTP server instead of memory")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--startup-budget", type=float, default=startup_budget_seconds, help="fail the startup stage if the window takes longer than this to show")
+    parser.add_argument("--memory-probe", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--scratch", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.memory_probe is not None:
+        memoryProbe(args.memory_probe, args.scratch)
+        return
+
+    fakeyoutubedl.track_bytes = args.track_bytes
+    fakeyoutubedl.source_format = args.source_format
+    fakeyoutubedl.cover_pixels = args.cover_pixels
+    fakeyoutubedl.http_throttle = args.throttle
+    segmented.segmented_threshold_bytes = args.segment_threshold
+    connections_per_track = args.connections
+    startup_budget_seconds = args.startup_budget
+    if args.http:
+        fakeyoutubedl.startServer()
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "track_bytes": args.track_bytes,
+            "source": "http" if args.http else "memory",
+            "source_format": args.source_format,
+            "cover_pixels": args.cover_pixels,
+            "throttle": args.throttle,
+            "connections_per_track": args.connections,
+            "segment_threshold": args.segment_threshold,
+            "pillow": importlib.util.find_spec("PIL") is not None,
+        },
+        "stages": {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix="downloadinator-bench-") as scratch:
+        for name in args.stages:
+            results["stages"][name] = {}
+            for count in ([1] if name in unsized_stages else args.sizes):
+                result = runStage(name, count, scratch)
+                results["stages"][name][str(count)] = result
+                print(f"{name:>16} {count:>6}: " + (describe(result) if result["status"] == "ok" else f"{result['status']} - {result['reason']}"))
+
+    with open(args.output, "w") as _file:
+        json.dump(results, _file, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 from __future__ import unicode_literals
-import youtube_dl
 import re
 import threading
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 import sys
@@ -10,17 +11,27 @@ from datetime import timedelta
 
 from typing import List
 
+from scheduler import DownloadScheduler, PostProcessingStage
+from metadatacache import PlaylistMetadataCache
+from progress import ProgressAggregator, formatBytes, formatEta
+from trackjob import TrackJob, writeAlbumGain
+from titlerules import compileRules
+from manifest import AlbumManifest
+from metrics import RunMetrics, track_stages
+from sessions import YoutubeDLPool
+from audiocache import AudioCache, audio_cache_max_bytes
+from loudness import LoudnessAnalyzer, numpyAvailable
+from previews import PreviewLoader, thumbnail_height
+from retry import RetryPolicy, classifyError, isThrottling
+from ratecontrol import TokenBucket, ConcurrencyController
+import segmented
+
 import os.path
-from mutagen.id3 import ID3, TPE1, TPE2, TIT2, TRCK, TALB, APIC, TYER, TCON, TRCK
-from mutagen.mp4 import MP4, MP4Cover
 
 def updateProgress(d):
     print(d)
 
 download_metadata_options = {
-    'writesubtitles': True,
-    'format': 'mp4',
-    'writethumbnail': True,
     'sleep_interval': 0,
     'max_sleep_interval': 0,
     'skip_download': True,
@@ -28,34 +39,94 @@ download_metadata_options = {
     'progress_hooks': [updateProgress],
 }
 
-download_all_at_once = False
+# Lists a playlist's video IDs and titles without resolving each video
+list_playlist_options = {
+    'extract_flat': 'in_playlist',
+    'skip_download': True,
+    'simulate': True,
+    'quiet': True,
+}
 
-important_keys = ["title", "duration", "webpage_url", "index"]
+# youtube_dl takes a good while to import and to build its extractor tables,
+# so it's left out of startup entirely: warmUpYoutubeDL creates the first
+# sessions in the background while the user is still typing a URL, and
+# every playlist download after that reuses them
+listing_sessions = YoutubeDLPool(list_playlist_options)
+metadata_sessions = YoutubeDLPool(download_metadata_options)
+
+def warmUpYoutubeDL():
+    with listing_sessions.session() as ydl:
+        ydl.get_info_extractor("YoutubeTab")
+    with metadata_sessions.session() as ydl:
+        ydl.get_info_extractor("Youtube")
+
+max_concurrent_downloads = 3
+
+# How long to wait after the last edit to the title rules before previewing
+title_rules_preview_delay = 250
+
+# How many times a second download progress is pushed to the window
+progress_refresh_rate = 15
+
+# How many videos to resolve at once while streaming a playlist, and how
+# often resolved entries are handed to the window
+metadata_resolve_workers = 4
+metadata_batch_size = 25
+metadata_batch_interval = 0.25
+
+important_keys = ["id", "title", "duration", "webpage_url", "index"]
+
+def pruneEntry(entry):
+    return { key: entry.get(key) for key in important_keys }
+
+def queuePosition(tracks, priority):
+    # Where a track with `priority` goes in `tracks`, which is sorted by
+    # priority (bisect only takes a key from 3.10 on)
+    low, high = 0, len(tracks)
+    while low < high:
+        middle = (low + high) // 2
+        if priority < tracks[middle].priority():
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+class TrackItem:
+    # Not a QObject: there can be tens of thousands of these, and only the
+    # model and the download threads need Qt. `parent` is the window.
+    __slots__ = [
+        "__parent", "__trackData", "__trackTitle", "__trackArtist", "__trackAlbum", "__albumArtPath", "__trackYear",
+        "__trackGenre", "__trackIndex", "__priority", "__downloadedBytes", "__downloading", "__progressText",
+        "__progress", "__downloadThread", "__downloadJob",
+        # Qt needs weak references to connect signals to our methods
+        "__weakref__",
+    ]
 
-class TrackItem(QtCore.QObject):
     def __init__(self, parent, trackData={"title": "TITLE", "duration": 0}, trackIndex = (0,0)):
-        super(TrackItem, self).__init__(parent)
-        self.__trackData = { key: trackData[key] for key in important_keys }
-        
-
+        self.__parent = parent
+        # Raw name, duration and URL are read straight from here rather than
+        # kept twice
+        self.__trackData = pruneEntry(trackData)
 
-        self.__rawName = trackData["title"]
         self.__trackTitle = trackData["title"]
         self.__trackArtist = "ARTIST"
         self.__trackAlbum = "ALBUM"
-        self.__trackAlbumArtPath = ""
+        self.__albumArtPath = ""
         self.__trackYear = "YEAR"
         self.__trackGenre = "Soundtrack"
-        self.__duration = trackData["duration"]
-
-        self.__url = trackData["webpage_url"]
 
         self.__trackIndex = trackIndex
+        self.__priority = trackIndex[0]
+        self.__downloadedBytes = 0
+        self.__downloading = False
 
-        
-
-        self.__progressBar: ProgressIndicator = None
+        self.__progressText = "Idle"
+        self.__progress = (0, 1)
         self.__downloadThread = None
+        self.__downloadJob = None
+
+    def parent(self):
+        return self.__parent
 
     def title(self):
         return self.__trackTitle
@@ -76,10 +147,10 @@ class TrackItem(QtCore.QObject):
         return self.__trackGenre
 
     def rawName(self):
-        return self.__rawName
+        return self.__trackData["title"]
 
     def duration(self):
-        return self.__duration
+        return self.__trackData["duration"]
 
     def readableDuration(self):
         return timedelta(seconds=self.duration())
@@ -87,12 +158,25 @@ class TrackItem(QtCore.QObject):
     def trackIndex(self):
         return self.__trackIndex
 
+    def setTrackIndex(self, trackIndex):
+        self.__trackIndex = trackIndex
+
     def url(self):
-        return self.__url
+        return self.__trackData["webpage_url"]
+
+    def priority(self):
+        return self.__priority
+
+    def setPriority(self, priority):
+        self.__priority = priority
 
     def trackData(self):
         return self.__trackData
 
+    def downloadJob(self):
+        # The TrackJob from this track's latest download, if it's had one
+        return self.__downloadJob
+
     def setTitle(self, title):
         self.__trackTitle = title
 
@@ -111,160 +195,303 @@ class TrackItem(QtCore.QObject):
     def setGenre(self, genre):
         self.__trackGenre = genre
 
-    def progressBar(self):
-        return self.__progressBar
+    def progressText(self):
+        return self.__progressText
 
-    def setProgressBar(self, bar):
-        self.__progressBar = bar
+    def progress(self):
+        return self.__progress
 
-    def applyRegexTitlePattern(self, pattern):
-        regexMatches = re.match(pattern, self.rawName())
-        if regexMatches is None:
-            print("no matches I guess??")
-        elif len(regexMatches.groups()) == 0:
-            print("Not enough groups!")
-        else:
-            self.setTitle(regexMatches.group(1))
+    def setProgress(self, text, progress):
+        self.__progressText = text
+        self.__progress = (progress[0], progress[1] if progress[1] is not None else 0)
+        self.parent().trackChanged(self)
 
 
-    def updateProgress(self, d):
+    def updateProgress(self, d, rate=0.0, eta=None):
+        # Progress is flushed on a timer, so a stale hook event can arrive
+        # after the post-processing stage has already picked the track up
+        if not self.__downloading:
+            return
+
         if d["status"] == "downloading":
             downloaded_bytes = d["downloaded_bytes"]
-            total_bytes = d["total_bytes"] if "total_bytes" in d else (d["total_bytes_estimate"] if "total_bytes_estimate" in d else None)
-            self.__progressBar.updateProgressBar(f"Downloading ({int((downloaded_bytes / total_bytes) * 100)}%)", (downloaded_bytes, total_bytes))
-            # print(f"Track {self.title()} is downloading: {downloaded_bytes} / {total_bytes if total_bytes is not None else '???'}")
+            self.parent().addDownloadedBytes(downloaded_bytes - self.__downloadedBytes)
+            self.__downloadedBytes = downloaded_bytes
+            total_bytes = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if total_bytes:
+                self.setProgress(f"Downloading ({int((downloaded_bytes / total_bytes) * 100)}%, {formatBytes(rate)}/s, {formatEta(eta)} left)", (downloaded_bytes, total_bytes))
+            else:
+                self.setProgress(f"Downloading ({formatBytes(downloaded_bytes)}, {formatBytes(rate)}/s)", (0, 0))
         elif d["status"] == "error":
             print(f"Track {self.title()} had an error while downloading")
-            self.__progressBar.updateProgressBar(f"Error", (0, 1))
+            self.setProgress("Error", (0, 1))
         elif d["status"] == "finished":
-            self.__progressBar.updateProgressBar(f"Processing", (0, 0))
+            self.setProgress("Waiting to process", (0, 0))
 
     def downloadAsMP3(self):
-        self.__downloadThread = TrackDownloaderThread(self)
-
-        self.__downloadThread.statusUpdated.connect(self.updateProgress)
-        self.__downloadThread.startingProcessing.connect(lambda: self.__progressBar.updateProgressBar("Processing", (0,0)))
+        self.__downloadedBytes = 0
+        self.__downloading = True
+        self.setProgress("Starting", (0, 0))
+        self.__downloadThread = TrackDownloaderThread(self, self.parent().postProcessingStage, self.parent().progressAggregator, self.parent().albumManifest, self.parent().runMetrics, self.parent().preferStreamCopyCheckBox.isChecked(), self.parent().downloadSessions, self.parent().connectionsPerTrackSpinBox.value(), self.parent().audioCache, self.parent().loudnessForDownloads(), self.parent().bandwidth)
+        self.__downloadJob = self.__downloadThread.job
+
+        # Carry the count over if this is a retry
+        self.__downloadThread.job.attempts = self.parent().retryAttempts.get(self, 0)
+
+        self.__downloadThread.downloadFinished.connect(self.downloadFinished)
+        self.__downloadThread.downloadFailed.connect(self.downloadFailed)
+        self.__downloadThread.startingProcessing.connect(self.startedProcessing)
         self.__downloadThread.allDone.connect(self.allDoneDownloading)
+        self.__downloadThread.processingFailed.connect(self.processingFailed)
 
         self.__downloadThread.start()
 
+    def startedProcessing(self):
+        self.__downloading = False
+        self.setProgress("Processing", (0,0))
+
+    def downloadFinished(self):
+        self.parent().trackDownloaded(self)
+
+    def downloadFailed(self, error):
+        self.__downloading = False
+        self.releaseDownloadThread()
+        self.parent().trackDownloadFailed(self, error)
+
     def allDoneDownloading(self):
-        self.__progressBar.updateProgressBar("Done", (1,1))
-        self.parent().trackCompleted()
+        self.__downloading = False
+        self.releaseDownloadThread()
+        self.setProgress("Done", (1,1))
+        self.parent().trackCompleted(self)
+
+    def processingFailed(self, error):
+        self.releaseDownloadThread()
+        self.parent().trackFailed(self, error)
+
+    def releaseDownloadThread(self):
+        # The thread is parented to the window, so it would otherwise stay
+        # around (signal connections and all) for as long as the window does.
+        # Its run() has returned by now, or is about to.
+        thread, self.__downloadThread = self.__downloadThread, None
+        if thread is not None:
+            thread.wait()
+            thread.deleteLater()
 
 class PlaylistMetadataDownloaderThread(QtCore.QThread):
+    entriesReady = QtCore.pyqtSignal(object)
     complete = QtCore.pyqtSignal(object)
     error = QtCore.pyqtSignal(object)
 
-    def __init__(self, parent, url):
+    def __init__(self, parent, url, cache=None, metrics=None):
         super(PlaylistMetadataDownloaderThread, self).__init__(parent)
         self.parent = parent
         self.url = url
+        self.cache = cache if cache is not None else PlaylistMetadataCache()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+
+        self.__batch = []
+        self.__batchLock = threading.Lock()
+        self.__lastFlush = 0
 
     def run(self):
+        with self.metrics.runSpan("metadata"):
+            self.fetchPlaylist()
+
+    def fetchPlaylist(self):
         try:
-            with youtube_dl.YoutubeDL(download_metadata_options) as ydl:
-                ie_result = ydl.extract_info(self.url, False)
-                if "_type" in ie_result: # it's a playlist
-
-                    index = 1
-                    for i in ie_result["entries"]:
-                        i["index"] = index
-                        index += 1
-
-                    self.complete.emit(ie_result["entries"])
-                else: # it's a single video
-                    self.complete.emit(ie_result)
+            cachedEntries = self.cache.freshPlaylist(self.url)
+            if cachedEntries is not None:
+                self.entriesReady.emit(cachedEntries)
+                self.complete.emit(cachedEntries)
+                return
+
+            # With process=False the playlist's entries come back as a lazy
+            # generator, so videos can be resolved while later pages are
+            # still being listed
+            with listing_sessions.session() as listing_ydl:
+                listing = listing_ydl.extract_info(self.url, False, process=False)
+                # Bare playlist IDs and embed URLs come back as a pointer to
+                # the real playlist, which processing would have followed
+                while listing.get("_type") in ("url", "url_transparent"):
+                    listing = listing_ydl.extract_info(listing["url"], False, ie_key=listing.get("ie_key"), process=False)
+
+                if listing.get("_type") not in ("playlist", "multi_video"): # it's a single video
+                    entry = pruneEntry(listing)
+                    entry["index"] = 1
+                    self.entriesReady.emit([entry])
+                    self.complete.emit([entry])
+                    return
+
+                # Only resolve videos we haven't seen, or whose listing changed
+                # since we last cached them; reuse everything else
+                knownEntries = self.cache.entries(self.url)
+                entries = []
+                resolvedIds = set()
+                self.__lastFlush = time.monotonic()
+
+                with ThreadPoolExecutor(metadata_resolve_workers) as pool:
+                    futures = []
+                    for index, flatEntry in enumerate(listing["entries"], start=1):
+                        entry = knownEntries.get(flatEntry.get("id"))
+                        if entry is None or entry["title"] != flatEntry.get("title", entry["title"]):
+                            futures.append(pool.submit(self.resolveEntry, flatEntry, index))
+                        else:
+                            entry["index"] = index
+                            entries.append(entry)
+                            self.addToBatch(entry)
+
+                    for future in futures:
+                        entry = future.result()
+                        if entry is not None:
+                            entries.append(entry)
+                            resolvedIds.add(entry["id"])
+
+            self.flushBatch()
+            self.metrics.count("metadata_resolved", len(resolvedIds))
+            self.metrics.count("metadata_reused", len(entries) - len(resolvedIds))
+
+            entries.sort(key=lambda entry: entry["index"])
+            self.cache.storePlaylist(self.url, entries, resolvedIds)
+            self.complete.emit(entries)
         except Exception as e:
             print(e)
             self.error.emit(e)
 
-class TrackDownloaderThread(QtCore.QThread):
-    statusUpdated = QtCore.pyqtSignal(object)
+    def resolveEntry(self, flatEntry, index):
+        # YoutubeDL instances aren't thread-safe, so each resolver checks
+        # one out of the pool for itself
+        try:
+            with metadata_sessions.session() as ydl:
+                # process=False skips format selection; we only keep important_keys
+                info = ydl.extract_info(flatEntry.get("url") or flatEntry["id"], False, ie_key=flatEntry.get("ie_key"), process=False)
+        except Exception as e:
+            print(f"Couldn't resolve {flatEntry.get('id')}: {e}")
+            return None
+
+        entry = pruneEntry(info)
+        entry["index"] = index
+        self.addToBatch(entry)
+        return entry
+
+    def addToBatch(self, entry):
+        with self.__batchLock:
+            self.__batch.append(entry)
+            if len(self.__batch) < metadata_batch_size and time.monotonic() - self.__lastFlush < metadata_batch_interval:
+                return
+        self.flushBatch()
+
+    def flushBatch(self):
+        with self.__batchLock:
+            batch, self.__batch = self.__batch, []
+            self.__lastFlush = time.monotonic()
+        if batch:
+            self.entriesReady.emit(batch)
 
+class TrackDownloaderThread(QtCore.QThread):
+    downloadFinished = QtCore.pyqtSignal()
+    downloadFailed = QtCore.pyqtSignal(object)
     startingProcessing = QtCore.pyqtSignal()
     allDone = QtCore.pyqtSignal()
+    processingFailed = QtCore.pyqtSignal(object)
 
-    def __init__(self, parent):
-        super(TrackDownloaderThread, self).__init__(parent)
+    def __init__(self, parent, postProcessingStage, progressAggregator, manifest=None, metrics=None, preferStreamCopy=False, sessions=None, connections=segmented.default_connections, audioCache=None, loudness=None, bandwidth=None):
+        # `parent` is the TrackItem, which isn't a QObject, so the thread
+        # belongs to the window
+        super(TrackDownloaderThread, self).__init__(parent.parent())
         self.parent = parent
-
+        self.postProcessingStage = postProcessingStage
+        self.progressAggregator = progressAggregator
+        self.job = TrackJob(parent, self.updateProgress, self.startingProcessing.emit, manifest, metrics, preferStreamCopy, sessions=sessions, connections=connections, audioCache=audioCache, loudness=loudness, bandwidth=bandwidth)
+        self.job.resumeState()
 
     def updateProgress(self, d):
-        self.statusUpdated.emit(d)
+        # Called many times a second from youtube_dl; just record the latest
+        # state and let the window pick it up on its next refresh
+        self.progressAggregator.report(self.parent, d)
 
     def run(self):
         self.downloadAsMP3Thread()
 
     def downloadAsMP3Thread(self):
-        download_mp3_options = {
-            'format': 'bestaudio/best',
-            'outtmpl': self.parent.album() + "/" + self.parent.title().replace('/', '\/') + ".",
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'm4a',
-                'preferredquality': '320',
-            }],
-            'prefer_ffmpeg': True,
-            'keepvideo': False,
-            'quiet': True,
-            'progress_hooks': [self.updateProgress],
-        }
-
-        with youtube_dl.YoutubeDL(download_mp3_options) as ydl:
-            ydl.download([self.parent.url()])
-
-        self.setM4AMetadata()
-
-
-    def setM4AMetadata(self):
-        self.startingProcessing.emit()
-        tags = MP4(f"{self.parent.album()}/{self.parent.title()}.m4a").tags
-        tags['\xa9nam'] = self.parent.title()
-        tags['\xa9alb'] = self.parent.album()
-        tags['\xa9ART'] = self.parent.artist()
-        tags['aART'] = self.parent.artist()
-        tags['\xa9wrt'] = self.parent.artist()
-        tags['\xa9day'] = self.parent.year()
-        tags['trkn'] = [self.parent.trackIndex()]
-
-        with open(self.parent.albumArtPath(), 'rb') as albumart:
-            tags['covr'] = [MP4Cover(albumart.read(), MP4Cover.FORMAT_PNG)]
-
-        tags.save(f"{self.parent.album()}/{self.parent.title()}.m4a")
+        # Network stage: only fetch the audio here. Transcoding and tagging
+        # happen on the post-processing stage so this slot can move on.
+        # Errors are handed to the window, which decides whether to retry;
+        # either way the slot has to be given back.
+        try:
+            self.job.download()
+        except Exception as e:
+            self.downloadFailed.emit(e)
+            return
 
+        # Blocks while the post-processing queue is full, which holds on to
+        # this download slot until the CPU-bound stage catches up
+        self.postProcessingStage.submit(self)
+        self.downloadFinished.emit()
 
+    def postProcess(self):
+        try:
+            self.job.postProcess()
+        except Exception as e:
+            self.processingFailed.emit(e)
+            return
         self.allDone.emit()
 
-    def setMP3Metadata(self):
-        self.startingProcessing.emit()
-        mp3_file = ID3(f"{self.parent.album()}/{self.parent.title()}.mp3")
-        mp3_file['TPE1'] = TPE1(encoding=3, text=self.parent.artist())
-        mp3_file['TPE2'] = TPE2(encoding=3, text=self.parent.artist())
-        mp3_file['TPE3'] = TPE2(encoding=3, text=self.parent.artist())
-        mp3_file['TALB'] = TALB(encoding=3, text=self.parent.album())
-        mp3_file['TYER'] = TYER(encoding=3, text=self.parent.year())
-        mp3_file['TCON'] = TCON(encoding=3, text=self.parent.genre())
-
-        if self.parent.trackIndex() != (0,0):
-            mp3_file["TRCK"] = TRCK(encoding=3, text=f"{self.parent.trackIndex()[0]}/{self.parent.trackIndex()[1]}")
-
-        if self.parent.albumArtPath() != "":
-            with open(self.parent.albumArtPath(), 'rb') as albumart:
-                mp3_file['APIC'] = APIC(
-                            encoding=3,
-                            mime='image/png',
-                            type=3, desc=u'Cover',
-                            data=albumart.read()
-                            ) 
-        mp3_file.save()
-        self.allDone.emit()
+class AlbumGainThread(QtCore.QThread):
+    # Waits for the last tracks' loudness and writes the album gain, off the
+    # GUI thread
+    def __init__(self, parent, jobs, metrics):
+        super(AlbumGainThread, self).__init__(parent)
+        self.jobs = jobs
+        self.metrics = metrics
+
+    def run(self):
+        try:
+            with self.metrics.runSpan("replaygain"):
+                writeAlbumGain(self.jobs)
+        except Exception as e:
+            print(f"Couldn't write ReplayGain tags: {e}")
+
+class TrackTimingsDialog(QtWidgets.QDialog):
+    def __init__(self, parent, metrics):
+        super(TrackTimingsDialog, self).__init__(parent)
+        self.setWindowTitle("Track timings")
+        self.resize(800, 400)
+
+        rows = metrics.slowestTracks()
+        headers = ["Track"] + [stage.replace("_", " ").capitalize() + " (s)" for stage in track_stages] + ["Total (s)", "Downloaded (MB)"]
+
+        self.table = QtWidgets.QTableWidget(len(rows), len(headers))
+        self.table.setHorizontalHeaderLabels(headers)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        for row, (label, total, stages, byteCounts) in enumerate(rows):
+            values = [stages[stage] for stage in track_stages] + [total, byteCounts.get("downloaded", 0) / 1e6]
+            self.table.setItem(row, 0, QtWidgets.QTableWidgetItem(label))
+            for column, value in enumerate(values, start=1):
+                # Store numbers rather than text so columns sort numerically
+                item = QtWidgets.QTableWidgetItem()
+                item.setData(QtCore.Qt.DisplayRole, round(value, 2))
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(len(headers) - 2, QtCore.Qt.DescendingOrder)
+        self.table.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.table)
+        self.setLayout(layout)
 
 class ArtworkPicker(QtWidgets.QWidget):
-    def __init__(self):
+    def __init__(self, previews):
         QtWidgets.QWidget.__init__(self)
+        # Decoded and scaled off the GUI thread, since the path is previewed
+        # on every keystroke and covers can be huge
+        self.__previews = previews
+        self.__previews.previewReady.connect(self.showPreview)
         self.setupUI()
-        self.setArtworkPath("SpiritOfJustice.png")
+        self.__artworkPath = "SpiritOfJustice.png"
+        self.__filePathEditor.setText(self.__artworkPath)
+        # Decoding and scaling the preview can wait until the window is up
+        QtCore.QTimer.singleShot(0, self.updatePreview)
 
 
     def setupUI(self):
@@ -297,10 +524,13 @@ class ArtworkPicker(QtWidgets.QWidget):
         self.updatePreview()
 
     def updatePreview(self):
-        previewPixmap = QtGui.QPixmap(self.__artworkPath)
-        if not previewPixmap.isNull():
-            previewPixmap = previewPixmap.scaledToHeight(128, QtCore.Qt.SmoothTransformation)
-            self.__artworkPreview.setPixmap(previewPixmap)
+        self.__previews.requestFile(self, self.__artworkPath)
+
+    def showPreview(self, slot, image):
+        if slot is not self:
+            return
+        if image is not None:
+            self.__artworkPreview.setPixmap(QtGui.QPixmap.fromImage(image))
             self.__artworkPreview.setScaledContents(False)
         else:
             self.__artworkPreview.clear()
@@ -312,40 +542,176 @@ class ArtworkPicker(QtWidgets.QWidget):
             self.setArtworkPath(fileName)
         
 
-class ProgressIndicator(QtWidgets.QWidget):
-    def __init__(self):
-        QtWidgets.QWidget.__init__(self)
-        self.setupUI()
-
-    def setupUI(self):
-        self.__layout = QtWidgets.QHBoxLayout()
-        self.__layout.setContentsMargins(5,0,5,0)
-
-        self.__label = QtWidgets.QLabel("Idle")
-        self.__bar = QtWidgets.QProgressBar()
-
-        self.__layout.addWidget(self.__label)
-        self.__layout.addWidget(self.__bar)
-        self.setLayout(self.__layout)
+class TrackQueueModel(QtCore.QAbstractTableModel):
+    ProgressRole = QtCore.Qt.UserRole + 1
+
+    headers = ["#", "Title", "Duration", "Progress"]
+
+    def __init__(self, parent=None, previews=None):
+        super(TrackQueueModel, self).__init__(parent)
+        self.__tracks: List[TrackItem] = []
+        self.__rows = None
+        # Thumbnails are only fetched for the rows the view actually asks for
+        self.__previews = previews
+        if previews is not None:
+            previews.previewReady.connect(self.thumbnailReady)
+
+    def setTracks(self, tracks):
+        if self.__previews is not None:
+            for track in self.__tracks:
+                self.__previews.cancel(track)
+        self.beginResetModel()
+        self.__tracks = list(tracks)
+        self.__rows = None
+        self.endResetModel()
+
+    def insertTracks(self, row, tracks):
+        # Adds rows without resetting the model, so the view keeps its
+        # scroll position and the other rows' thumbnails carry on loading
+        if not tracks:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(tracks) - 1)
+        self.__tracks[row:row] = tracks
+        self.__rows = None
+        self.endInsertRows()
 
-    def updateProgressBar(self, text, progress):
-        if progress[1] is None: progress[1] = 0
-        self.__label.setText(text)
-        self.__bar.setRange(progress[0], progress[1])
-        self.__bar.setValue(progress[0])
+    def moveTrack(self, row, destination):
+        if row == destination:
+            return
+        # beginMoveRows wants the row it goes before, counted before the move
+        self.beginMoveRows(QtCore.QModelIndex(), row, row, QtCore.QModelIndex(), destination + 1 if destination > row else destination)
+        self.__tracks.insert(destination, self.__tracks.pop(row))
+        self.__rows = None
+        self.endMoveRows()
+
+    def track(self, row):
+        return self.__tracks[row]
+
+    def hasTracks(self, tracks):
+        return len(tracks) == len(self.__tracks) and all(a is b for a, b in zip(tracks, self.__tracks))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.__tracks)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        track = self.__tracks[index.row()]
+        column = index.column()
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return str(track.trackIndex()[0])
+            elif column == 1:
+                return track.title()
+            elif column == 2:
+                return str(track.readableDuration())
+            elif column == 3:
+                return track.progressText()
+        elif role == QtCore.Qt.DecorationRole and column == 1 and self.__previews is not None:
+            # Only what's already loaded; ThumbnailDelegate asks for the rest
+            return self.__previews.cachedThumbnail(track.trackData().get("id"))
+        elif role == TrackQueueModel.ProgressRole and column == 3:
+            return track.progress()
+        return None
+
+    def requestThumbnail(self, row):
+        if self.__previews is not None:
+            track = self.__tracks[row]
+            self.__previews.thumbnail(track, track.trackData().get("id"))
+
+    def thumbnailReady(self, track, image):
+        if image is not None:
+            self.trackChanged(track, 1, 1)
+
+    def trackChanged(self, track, firstColumn=0, lastColumn=3):
+        # Rows move whenever tracks are inserted, so they're only looked up
+        # again once something changes
+        if self.__rows is None:
+            self.__rows = { track: row for row, track in enumerate(self.__tracks) }
+        row = self.__rows.get(track)
+        if row is not None:
+            self.dataChanged.emit(self.index(row, firstColumn), self.index(row, lastColumn))
+
+    def allTracksChanged(self, firstColumn=0, lastColumn=3):
+        if self.__tracks:
+            self.dataChanged.emit(self.index(0, firstColumn), self.index(len(self.__tracks) - 1, lastColumn))
+
+
+class ThumbnailDelegate(QtWidgets.QStyledItemDelegate):
+    # Thumbnails are fetched as rows are painted, so only the rows scrolled
+    # into view are ever fetched (and none at all while the window's hidden)
+    def paint(self, painter, option, index):
+        index.model().requestThumbnail(index.row())
+        super(ThumbnailDelegate, self).paint(painter, option, index)
+
+    def sizeHint(self, option, index):
+        # As tall as a thumbnail whether or not it's loaded yet
+        hint = super(ThumbnailDelegate, self).sizeHint(option, index)
+        return QtCore.QSize(hint.width(), max(hint.height(), thumbnail_height + 2))
+
+class ProgressDelegate(QtWidgets.QStyledItemDelegate):
+    def paint(self, painter, option, index):
+        progress = index.data(TrackQueueModel.ProgressRole)
+        if progress is None:
+            return super(ProgressDelegate, self).paint(painter, option, index)
+
+        # Range (0, 0) is drawn as a busy indicator, same as QProgressBar
+        bar = QtWidgets.QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(5, 2, -5, -2)
+        bar.minimum = 0
+        bar.maximum = progress[1]
+        bar.progress = min(progress[0], progress[1])
+        bar.text = index.data(QtCore.Qt.DisplayRole)
+        bar.textVisible = True
+        bar.state = option.state
+
+        style = option.widget.style() if option.widget is not None else QtWidgets.QApplication.style()
+        style.drawControl(QtWidgets.QStyle.CE_ProgressBar, bar, painter, option.widget)
+
+    def sizeHint(self, option, index):
+        hint = super(ProgressDelegate, self).sizeHint(option, index)
+        return QtCore.QSize(max(hint.width(), 200), hint.height())
 
 class MyWindow(QtWidgets.QMainWindow):
     def __init__(self):
         QtWidgets.QMainWindow.__init__(self)
 
         self.track_list: List[TrackItem] = []
-        self.current_track_index = 0
-        self.downloadingInProgress = True
+        self.downloadingInProgress = False
+        self.downloadScheduler: DownloadScheduler = None
+        self.postProcessingStage: PostProcessingStage = None
+        self.albumManifest: AlbumManifest = None
         self.tracksCompleted = 0
 
-        self.leftHandQueue = QtWidgets.QTreeWidget()
-        self.leftHandQueue.setHeaderLabels(["#", "Title", "Duration", "Progress"])
-        self.leftHandQueue.header().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+        self.previewLoader = PreviewLoader(self)
+        self.trackQueueModel = TrackQueueModel(self, self.previewLoader)
+        self.leftHandQueue = QtWidgets.QTreeView()
+        self.leftHandQueue.setModel(self.trackQueueModel)
+        self.leftHandQueue.setItemDelegateForColumn(1, ThumbnailDelegate(self.leftHandQueue))
+        self.leftHandQueue.setItemDelegateForColumn(3, ProgressDelegate(self.leftHandQueue))
+        self.leftHandQueue.setRootIsDecorated(False)
+        self.leftHandQueue.setUniformRowHeights(True)
+        self.leftHandQueue.setIconSize(QtCore.QSize(thumbnail_height * 16 // 9, thumbnail_height))
+        # Columns are sized up front rather than to their contents, which
+        # would mean going through hundreds of rows every time some are added
+        queueFont = self.leftHandQueue.fontMetrics()
+        self.leftHandQueue.header().setSectionResizeMode(QtWidgets.QHeaderView.Interactive)
+        self.leftHandQueue.header().resizeSection(0, queueFont.horizontalAdvance("00000") + 12)
+        self.leftHandQueue.header().resizeSection(1, thumbnail_height * 16 // 9 + queueFont.averageCharWidth() * 48)
+        self.leftHandQueue.header().resizeSection(2, queueFont.horizontalAdvance("0:00:00") + 12)
+        self.leftHandQueue.header().resizeSection(3, 200)
+        self.leftHandQueue.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.leftHandQueue.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.leftHandQueue.customContextMenuRequested.connect(self.showQueueContextMenu)
 
         self.rightHandDetailsWidget = QtWidgets.QWidget()
 
@@ -358,6 +724,29 @@ class MyWindow(QtWidgets.QMainWindow):
 
         self.setWindowTitle("YouTube Downloadinator")
 
+        self.throughputLabel = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.throughputLabel)
+        self.progressAggregator = ProgressAggregator()
+        self.progressTimer = QtCore.QTimer(self)
+        self.progressTimer.setInterval(1000 // progress_refresh_rate)
+        self.progressTimer.timeout.connect(self.flushProgress)
+        self.runMetrics = RunMetrics()
+        # Kept for as long as the window is open, so later albums reuse the
+        # same sessions too
+        self.downloadSessions = YoutubeDLPool()
+        self.audioCache = None
+        self.loudnessAnalyzer = LoudnessAnalyzer()
+        self.albumGainThread = None
+        # A track that fails on a network error gives up its slot and goes
+        # back in the queue after a while; anything else fails it for good
+        self.retryPolicy = RetryPolicy()
+        self.retryAttempts = {}
+        self.failedTracks = []
+        self.failureSummary = None
+        # Shared by every download, and changeable while they run
+        self.bandwidth = TokenBucket()
+        self.concurrencyController = None
+
         self.setUpRightHandSide()
 
     def setUpRightHandSide(self):
@@ -390,15 +779,28 @@ class MyWindow(QtWidgets.QMainWindow):
         self.albumDataGroupBox = QtWidgets.QGroupBox("Album Information")
         self.albumDataGroupBox.setSizePolicy(QtWidgets.QSizePolicy.Policy.Minimum, QtWidgets.QSizePolicy.Policy.MinimumExpanding)
 
-        self.songNameRegexLineEdit = QtWidgets.QLineEdit("^(.*)[\s*]-")
+        self.songNameRulesEdit = QtWidgets.QPlainTextEdit("^(.*)[\s*]-")
+        self.songNameRulesEdit.setToolTip(
+            "One rule per line, tried in order.\n"
+            "s/pattern/replacement/ rewrites the title.\n"
+            "Any other regex picks the title from its 'title' group or group 1;\n"
+            "the first one that matches wins."
+        )
+        self.songNameRulesEdit.setFixedHeight(self.songNameRulesEdit.fontMetrics().lineSpacing() * 4)
+        self.songNameRulesEdit.textChanged.connect(self.titleRulesEdited)
+
+        self.titleRulesTimer = QtCore.QTimer(self)
+        self.titleRulesTimer.setSingleShot(True)
+        self.titleRulesTimer.setInterval(title_rules_preview_delay)
+        self.titleRulesTimer.timeout.connect(self.previewTitleRules)
         self.albumDataGroupBox_albumName = QtWidgets.QLineEdit("Phoenix Wright: Ace Attorney − Spirit of Justice")
         self.albumDataGroupBox_artistName = QtWidgets.QLineEdit("Capcom")
         self.albumDataGroupBox_year = QtWidgets.QLineEdit("2016")
-        self.albumDataGroupBox_artworkPicker = ArtworkPicker()
+        self.albumDataGroupBox_artworkPicker = ArtworkPicker(self.previewLoader)
 
         self.albumDataLayout = QtWidgets.QFormLayout()
         self.albumDataLayout.setFieldGrowthPolicy(QtWidgets.QFormLayout.ExpandingFieldsGrow)
-        self.albumDataLayout.addRow(QtWidgets.QLabel("Title Pattern"), self.songNameRegexLineEdit)
+        self.albumDataLayout.addRow(QtWidgets.QLabel("Title Rules"), self.songNameRulesEdit)
         self.albumDataLayout.addRow(QtWidgets.QLabel("Album"), self.albumDataGroupBox_albumName)
         self.albumDataLayout.addRow(QtWidgets.QLabel("Artist"), self.albumDataGroupBox_artistName)
         self.albumDataLayout.addRow(QtWidgets.QLabel("Year"), self.albumDataGroupBox_year)
@@ -406,11 +808,67 @@ class MyWindow(QtWidgets.QMainWindow):
         self.albumDataGroupBox.setLayout(self.albumDataLayout)
 
 
+        ## Download options
+        self.concurrentDownloadsSpinBox = QtWidgets.QSpinBox()
+        self.concurrentDownloadsSpinBox.setRange(1, 32)
+        self.concurrentDownloadsSpinBox.setValue(max_concurrent_downloads)
+        self.concurrentDownloadsSpinBox.valueChanged.connect(self.setMaxConcurrentDownloads)
+
+        self.downloadOptionsLayout = QtWidgets.QFormLayout()
+        self.downloadOptionsLayout.addRow(QtWidgets.QLabel("Simultaneous downloads"), self.concurrentDownloadsSpinBox)
+
+        # Raises or lowers the number above as the downloads go, backing off
+        # when YouTube starts throttling
+        self.adaptiveDownloadsCheckBox = QtWidgets.QCheckBox("Adjust automatically")
+        self.downloadOptionsLayout.addRow(self.adaptiveDownloadsCheckBox)
+
+        self.maxBandwidthSpinBox = QtWidgets.QDoubleSpinBox()
+        self.maxBandwidthSpinBox.setRange(0, 1000)
+        self.maxBandwidthSpinBox.setDecimals(1)
+        self.maxBandwidthSpinBox.setSuffix(" MB/s")
+        self.maxBandwidthSpinBox.setSpecialValueText("Unlimited")
+        self.maxBandwidthSpinBox.valueChanged.connect(self.setMaxBandwidth)
+        self.downloadOptionsLayout.addRow(QtWidgets.QLabel("Bandwidth limit"), self.maxBandwidthSpinBox)
+
+        # Long tracks are split into byte ranges fetched side by side, since
+        # each connection is throttled on its own
+        self.connectionsPerTrackSpinBox = QtWidgets.QSpinBox()
+        self.connectionsPerTrackSpinBox.setRange(1, 16)
+        self.connectionsPerTrackSpinBox.setValue(segmented.default_connections)
+        self.connectionsPerTrackSpinBox.setToolTip(f"Used for tracks of {segmented.segmented_threshold_bytes // (1024 * 1024)} MB or more")
+        self.downloadOptionsLayout.addRow(QtWidgets.QLabel("Connections per long track"), self.connectionsPerTrackSpinBox)
+
+        # Audio shared between albums, so the same video is only downloaded
+        # once; each track's output is copied into it, which costs a second
+        # write where the filesystem can't clone files
+        self.audioCacheSizeSpinBox = QtWidgets.QSpinBox()
+        self.audioCacheSizeSpinBox.setRange(0, 1024 * 1024)
+        self.audioCacheSizeSpinBox.setSingleStep(1024)
+        self.audioCacheSizeSpinBox.setValue(audio_cache_max_bytes // (1024 * 1024))
+        self.audioCacheSizeSpinBox.setSuffix(" MB")
+        self.audioCacheSizeSpinBox.setSpecialValueText("Off")
+        self.downloadOptionsLayout.addRow(QtWidgets.QLabel("Audio cache"), self.audioCacheSizeSpinBox)
+
+        # AAC downloads only need remuxing, not re-encoding, so they're
+        # post-processed in milliseconds rather than seconds
+        self.preferStreamCopyCheckBox = QtWidgets.QCheckBox("Prefer AAC (skips re-encoding)")
+        self.downloadOptionsLayout.addRow(self.preferStreamCopyCheckBox)
+
+        # Measured in separate processes as tracks finish, so it doesn't slow
+        # the downloads down
+        self.replayGainCheckBox = QtWidgets.QCheckBox("Write ReplayGain tags")
+        if not numpyAvailable():
+            self.replayGainCheckBox.setEnabled(False)
+            self.replayGainCheckBox.setToolTip("Needs NumPy")
+        self.downloadOptionsLayout.addRow(self.replayGainCheckBox)
+
         ## Download button
         self.previewButton = QtWidgets.QPushButton("Preview")
         self.previewButton.clicked.connect(self.updatePreview)
         self.downloadButton = QtWidgets.QPushButton("Download")
         self.downloadButton.clicked.connect(self.downloadTracks)
+        self.timingsButton = QtWidgets.QPushButton("Timings…")
+        self.timingsButton.clicked.connect(self.showTimings)
 
         ## Final stuff
         self.rightHandDetailsLayout.addWidget(self.saveLoadBox)
@@ -420,12 +878,18 @@ class MyWindow(QtWidgets.QMainWindow):
         self.rightHandDetailsLayout.addWidget(self.albumDataGroupBox)
         self.rightHandDetailsLayout.addSpacing(10)
 
+        self.rightHandDetailsLayout.addLayout(self.downloadOptionsLayout)
         self.rightHandDetailsLayout.addWidget(self.previewButton)
         self.rightHandDetailsLayout.addWidget(self.downloadButton)
+        self.rightHandDetailsLayout.addWidget(self.timingsButton)
 
         self.rightHandDetailsWidget.setLayout(self.rightHandDetailsLayout)
 
-        self.updatePreview()
+        QtCore.QTimer.singleShot(0, self.updatePreview)
+        QtCore.QTimer.singleShot(0, self.warmUp)
+
+    def warmUp(self):
+        threading.Thread(target=warmUpYoutubeDL, daemon=True).start()
 
     def saveConfig(self):
         fileName, _ = QtWidgets.QFileDialog.getSaveFileName(self,"Save configuration file","","JSON file (*.json)")
@@ -445,11 +909,18 @@ class MyWindow(QtWidgets.QMainWindow):
 
     def loadConfigDictionary(self, dict):
         self.urlGroupBox_lineEntry.setText(dict["playlist_url"])
-        self.songNameRegexLineEdit.setText(dict["title_pattern"])
+        self.songNameRulesEdit.setPlainText(dict["title_pattern"])
         self.albumDataGroupBox_artistName.setText(dict["artist"])
         self.albumDataGroupBox_albumName.setText(dict["album"])
         self.albumDataGroupBox_year.setText(dict["year"])
         self.albumDataGroupBox_artworkPicker.setArtworkPath(dict["album_art_path"])
+        self.concurrentDownloadsSpinBox.setValue(dict.get("max_concurrent_downloads", max_concurrent_downloads))
+        self.adaptiveDownloadsCheckBox.setChecked(dict.get("adaptive_downloads", False))
+        self.maxBandwidthSpinBox.setValue(dict.get("max_bandwidth", 0))
+        self.preferStreamCopyCheckBox.setChecked(dict.get("prefer_stream_copy", False))
+        self.connectionsPerTrackSpinBox.setValue(dict.get("connections_per_track", segmented.default_connections))
+        self.audioCacheSizeSpinBox.setValue(dict.get("audio_cache_size", audio_cache_max_bytes // (1024 * 1024)))
+        self.replayGainCheckBox.setChecked(dict.get("replaygain", False) and self.replayGainCheckBox.isEnabled())
         
         for track_item in dict["tracks"]:
             self.track_list.append(TrackItem(self, track_item, (track_item["index"], len(dict["tracks"]))))
@@ -459,18 +930,32 @@ class MyWindow(QtWidgets.QMainWindow):
     def getConfigDictionary(self):
         return {
             "playlist_url": self.urlGroupBox_lineEntry.text(),
-            "title_pattern": self.songNameRegexLineEdit.text(),
+            "title_pattern": self.songNameRulesEdit.toPlainText(),
             "artist": self.albumDataGroupBox_artistName.text(),
             "album": self.albumDataGroupBox_albumName.text(),
             "year": self.albumDataGroupBox_year.text(),
             "album_art_path": self.albumDataGroupBox_artworkPicker.artworkPath(),
-            "tracks": [track_item.trackData() for track_item in self.track_list]
+            "max_concurrent_downloads": self.concurrentDownloadsSpinBox.value(),
+            "adaptive_downloads": self.adaptiveDownloadsCheckBox.isChecked(),
+            "max_bandwidth": self.maxBandwidthSpinBox.value(),
+            "prefer_stream_copy": self.preferStreamCopyCheckBox.isChecked(),
+            "connections_per_track": self.connectionsPerTrackSpinBox.value(),
+            "audio_cache_size": self.audioCacheSizeSpinBox.value(),
+            "replaygain": self.replayGainCheckBox.isChecked(),
+            # In playlist order, whatever order they're queued in
+            "tracks": [track_item.trackData() for track_item in sorted(self.track_list, key=lambda track_item: track_item.trackIndex()[0])]
         }
     
     def downloadTrackList(self):
         print("Download track list")
-        playlistMetadataThread = PlaylistMetadataDownloaderThread(self, self.urlGroupBox_lineEntry.text())
-        playlistMetadataThread.complete.connect(self.trackListDownloaded)
+        self.track_list.clear()
+        self.updatePreview()
+
+        self.runMetrics = RunMetrics()
+        playlistMetadataThread = PlaylistMetadataDownloaderThread(self, self.urlGroupBox_lineEntry.text(), metrics=self.runMetrics)
+        playlistMetadataThread.entriesReady.connect(self.trackListDownloaded)
+        playlistMetadataThread.complete.connect(self.trackListComplete)
+        playlistMetadataThread.error.connect(self.trackListComplete)
         playlistMetadataThread.start()
 
         self.urlGroupBox_goButton.setEnabled(False)
@@ -479,10 +964,35 @@ class MyWindow(QtWidgets.QMainWindow):
         self.repaint()
 
     def trackListDownloaded(self, data):
-        self.track_list.clear()
-
-        for track in data:
-            self.track_list.append(TrackItem(self, track, (track["index"], len(data))))
+        # Batches arrive in whatever order they were resolved, so keep the
+        # list in download order as they come in (a track's priority starts
+        # out as its playlist position). Only the new tracks are titled and
+        # added to the queue, so a batch costs the same however many tracks
+        # are already there.
+        tracks = [TrackItem(self, track, (track["index"], 0)) for track in sorted(data, key=lambda track: track["index"])]
+        self.applyAlbumFields(tracks)
+        self.applyTitleRules(tracks)
+
+        # Tracks landing next to each other go in as one run of rows; runs
+        # are inserted back to front so the positions ahead stay valid
+        runs = []
+        for track in tracks:
+            position = queuePosition(self.track_list, track.priority())
+            if runs and runs[-1][0] == position:
+                runs[-1][1].append(track)
+            else:
+                runs.append((position, [track]))
+
+        wasEmpty = not self.track_list
+        for position, run in reversed(runs):
+            self.track_list[position:position] = run
+            self.trackQueueModel.insertTracks(position, run)
+        if wasEmpty and self.track_list:
+            self.setButtonsEnabled(True)
+
+    def trackListComplete(self, result=None):
+        for track in self.track_list:
+            track.setTrackIndex((track.trackIndex()[0], len(self.track_list)))
 
         self.updatePreview()
 
@@ -501,36 +1011,56 @@ class MyWindow(QtWidgets.QMainWindow):
 
     def updatePreview(self):
         # Apply our changes to each item in the queue
+        self.titleRulesTimer.stop()
+        self.applyTitleRules()
+        self.applyAlbumFields(self.track_list)
+        self.populateLeftHandSideWithTracks()
+
+    def applyAlbumFields(self, tracks):
         artistName = self.albumDataGroupBox_artistName.text()
         albumName = self.albumDataGroupBox_albumName.text()
         albumYear = self.albumDataGroupBox_year.text()
-        regexPattern = self.songNameRegexLineEdit.text()
         albumArtPath = self.albumDataGroupBox_artworkPicker.artworkPath()
-        for track in self.track_list:
-            track.applyRegexTitlePattern(regexPattern)
+        for track in tracks:
             track.setArtist(artistName)
             track.setAlbum(albumName)
             track.setYear(albumYear)
             track.setAlbumArtPath(albumArtPath)
-            track.setProgressBar(ProgressIndicator())
-        self.populateLeftHandSideWithTracks()
-        
 
-    def populateLeftHandSideWithTracks(self):
-        print("Populate list of tracks")
+    def applyTitleRules(self, tracks=None):
+        tracks = self.track_list if tracks is None else tracks
+        try:
+            rules = compileRules(self.songNameRulesEdit.toPlainText())
+        except re.error as e:
+            self.statusBar().showMessage(f"Invalid title rule: {e}")
+            return False
 
-        while self.leftHandQueue.takeTopLevelItem(0) is not None: pass
+        self.statusBar().clearMessage()
+        titles = rules.applyAll([track.rawName() for track in tracks])
+        for track, title in zip(tracks, titles):
+            track.setTitle(title)
+        return True
 
+    def titleRulesEdited(self):
+        # Wait for a pause in typing rather than re-titling on every keystroke
+        self.titleRulesTimer.start()
+
+    def previewTitleRules(self):
+        if self.applyTitleRules():
+            self.trackQueueModel.allTracksChanged(1, 1)
+
+    def populateLeftHandSideWithTracks(self):
         self.setButtonsEnabled(len(self.track_list) != 0)
 
-        for track in self.track_list:
-            new_list_item = QtWidgets.QTreeWidgetItem()
-            new_list_item.setText(0, str(track.trackIndex()[0]))
-            new_list_item.setText(1, track.title())
-            new_list_item.setText(2, str(track.readableDuration()))
-        
-            self.leftHandQueue.addTopLevelItem(new_list_item)
-            self.leftHandQueue.setItemWidget(new_list_item, 3, track.progressBar())
+        # Only rebuild the model when the tracks themselves change; a preview
+        # just changes titles, so repaint that column in place
+        if self.trackQueueModel.hasTracks(self.track_list):
+            self.trackQueueModel.allTracksChanged(1, 1)
+        else:
+            self.trackQueueModel.setTracks(self.track_list)
+
+    def trackChanged(self, track):
+        self.trackQueueModel.trackChanged(track)
 
 
     def downloadTracks(self):
@@ -543,39 +1073,220 @@ class MyWindow(QtWidgets.QMainWindow):
 
         self.downloadingInProgress = True
         self.tracksCompleted = 0
+        self.retryAttempts.clear()
+        self.failedTracks.clear()
 
         self.urlGroupBox.setEnabled(False)
         self.albumDataGroupBox.setEnabled(False)
         self.setButtonsEnabled(False)
 
+        # Downloading is I/O-bound, so it gets its own (user-set) number of
+        # slots; transcoding and tagging are CPU-bound, so they run on a
+        # separate stage sized to the number of cores
+        if self.postProcessingStage is None:
+            self.postProcessingStage = PostProcessingStage(lambda downloader: downloader.postProcess())
+
+        # Keep a fixed number of tracks downloading at once, and start the
+        # next one in the queue whenever a slot frees up
+        self.downloadScheduler = DownloadScheduler(
+            lambda track: track.downloadAsMP3(),
+            self.concurrentDownloadsSpinBox.value()
+        )
+        self.concurrencyController = None
+        if self.adaptiveDownloadsCheckBox.isChecked():
+            # Its changes go through the spin box, so they show
+            self.concurrencyController = ConcurrencyController(self.concurrentDownloadsSpinBox.setValue, self.concurrentDownloadsSpinBox.value(), bandwidth=self.bandwidth)
+        # Skip anything the album's manifest says is already finished with
+        # up-to-date tags; those that only need re-tagging still go through
+        # the queue but won't download anything
+        self.albumManifest = AlbumManifest(albumName)
+        # Sized in MB, like batch.py's --audio-cache-size; 0 turns it off
+        cacheSize = self.audioCacheSizeSpinBox.value()
+        self.audioCache = AudioCache(maxBytes=cacheSize * 1024 * 1024) if cacheSize > 0 else None
+        if self.runMetrics.trackCount() > 0:
+            self.runMetrics = RunMetrics()
+        for track in self.track_list:
+            if self.albumManifest.trackState(track, TrackJob(track).outputPath("m4a")) == AlbumManifest.COMPLETE:
+                track.setProgress("Done", (1,1))
+                self.tracksCompleted += 1
+            else:
+                self.runMetrics.setLabel(track, f"{track.trackIndex()[0]}. {track.title()}")
+                self.runMetrics.begin(track, "queue_wait")
+                self.downloadScheduler.enqueue(track, track.priority())
+
+        self.progressAggregator.clear()
+        self.progressAggregator.addTracks(self.track_list)
+        self.progressTimer.start()
+        self.downloadScheduler.start()
 
-        if download_all_at_once:
-            for track in self.track_list:
-                track.downloadAsMP3()
+        if self.tracksCompleted == len(self.track_list):
+            self.allTracksCompleted()
 
-        else:
-            # don't download all at once
-            # Instead, start by downloading the first one
-            # and once that's done, start downloading the next one...
-            self.current_track_index = 0
-            self.track_list[self.current_track_index].downloadAsMP3()
+    def loudnessForDownloads(self):
+        return self.loudnessAnalyzer if self.replayGainCheckBox.isChecked() else None
+
+    def trackDownloaded(self, track):
+        self.downloadScheduler.jobFinished(track)
+        self.updateThroughputLabel()
+
+    def trackDownloadFailed(self, track, error):
+        attempts = track.downloadJob().attempts
+        if self.concurrencyController is not None and isThrottling(error):
+            self.concurrencyController.throttled()
+        delay = self.retryPolicy.retryDelay(attempts, error)
+        if delay is None:
+            self.downloadScheduler.jobFinished(track)
+            self.updateThroughputLabel()
+            self.trackFailed(track, error)
+            return
+
+        self.retryAttempts[track] = attempts
+        self.runMetrics.count("download_retries")
+        self.runMetrics.begin(track, "queue_wait")
+        track.setProgress(f"Retrying in {delay:.0f}s", (0, 1))
+        scheduler = self.downloadScheduler
+        scheduler.park(track)
+        QtCore.QTimer.singleShot(int(delay * 1000), lambda: scheduler.unpark(track, track.priority()))
+
+    def trackFailed(self, track, error):
+        track.setProgress("Failed", (0, 1))
+        self.failedTracks.append((track, error, track.downloadJob().attempts))
+        self.trackCompleted(track)
 
-    def trackCompleted(self):
+    def trackCompleted(self, track):
         self.tracksCompleted += 1
         if self.tracksCompleted == len(self.track_list):
             self.allTracksCompleted()
+
+    def addDownloadedBytes(self, count):
+        if self.downloadScheduler is not None:
+            self.downloadScheduler.addBytes(count)
+
+    def setMaxConcurrentDownloads(self, count):
+        if self.downloadScheduler is not None:
+            self.downloadScheduler.setMaxWorkers(count)
+        if self.concurrencyController is not None:
+            self.concurrencyController.setLimit(count)
+
+    def setMaxBandwidth(self, megabytesPerSecond):
+        self.bandwidth.setRate(megabytesPerSecond * 1024 * 1024)
+
+    def updateThroughputLabel(self):
+        if self.downloadScheduler is None:
+            self.throughputLabel.clear()
             return
 
-        if not download_all_at_once:
-            self.current_track_index += 1
-            self.track_list[self.current_track_index].downloadAsMP3()
+        tracksPerMinute, _ = self.downloadScheduler.throughput()
+        downloadedBytes, totalBytes, bytesPerSecond, eta = self.progressAggregator.overall()
+        self.throughputLabel.setText(
+            f"{self.downloadScheduler.completedCount()}/{self.downloadScheduler.totalCount()} tracks, "
+            f"{self.downloadScheduler.inFlightCount()} active, "
+            f"{formatBytes(downloadedBytes)}"
+            f"{' of ~' + formatBytes(totalBytes) if totalBytes else ''}, "
+            f"{tracksPerMinute:.1f} tracks/min, {formatBytes(bytesPerSecond)}/s, "
+            f"{formatEta(eta) if self.downloadingInProgress else '0:00'} left"
+        )
+
+    def flushProgress(self):
+        for track, (d, rate, eta) in self.progressAggregator.drain().items():
+            track.updateProgress(d, rate, eta)
+        self.updateThroughputLabel()
+
+        if self.concurrencyController is not None and self.downloadingInProgress:
+            self.concurrencyController.tick(self.progressAggregator.overall()[2], self.progressAggregator.activeRates(), self.downloadScheduler.inFlightCount())
+
+    def showQueueContextMenu(self, position):
+        selectedTracks = self.selectedTracks()
+        if len(selectedTracks) == 0:
+            return
+
+        menu = QtWidgets.QMenu(self)
+        downloadFirstAction = menu.addAction("Download first")
+        downloadLastAction = menu.addAction("Download last")
+        chosenAction = menu.exec_(self.leftHandQueue.viewport().mapToGlobal(position))
+
+        if chosenAction == downloadFirstAction:
+            # Move them to the front, keeping their relative order
+            for track in reversed(selectedTracks):
+                self.moveTrackInQueue(track, toFront=True)
+        elif chosenAction == downloadLastAction:
+            for track in selectedTracks:
+                self.moveTrackInQueue(track, toFront=False)
+
+    def selectedTracks(self):
+        rows = sorted(index.row() for index in self.leftHandQueue.selectionModel().selectedRows())
+        return [self.track_list[row] for row in rows if 0 <= row < len(self.track_list)]
+
+    def moveTrackInQueue(self, track, toFront):
+        # The queue is shown in download order, so the lowest and highest
+        # priorities are at either end of it
+        row = self.track_list.index(track)
+        destination = 0 if toFront else len(self.track_list) - 1
+        track.setPriority(self.track_list[0].priority() - 1 if toFront else self.track_list[-1].priority() + 1)
+        if self.downloadScheduler is not None and self.downloadScheduler.isRunning():
+            self.downloadScheduler.setPriority(track, track.priority())
+
+        self.track_list.insert(destination, self.track_list.pop(row))
+        self.trackQueueModel.moveTrack(row, destination)
 
     def allTracksCompleted(self):
         self.downloadingInProgress = False
+        self.progressTimer.stop()
+        self.flushProgress()
+
+        if self.replayGainCheckBox.isChecked():
+            # Tracks skipped this time were measured the last time they
+            # were downloaded, or get measured now
+            jobs = [track.downloadJob() or TrackJob(track, manifest=self.albumManifest) for track in self.track_list]
+            for job in jobs:
+                job.manifest = self.albumManifest
+                job.loudness = self.loudnessAnalyzer
+            self.statusBar().showMessage("Measuring loudness…")
+            self.albumGainThread = AlbumGainThread(self, jobs, self.runMetrics)
+            self.albumGainThread.finished.connect(self.albumCompleted)
+            self.albumGainThread.start()
+        else:
+            self.albumCompleted()
+
+    def albumCompleted(self):
+        self.statusBar().clearMessage()
         self.urlGroupBox.setEnabled(True)
         self.albumDataGroupBox.setEnabled(True)
         self.setButtonsEnabled(True)
 
+        # Leave the timings next to the album so slow runs can be looked at
+        # afterwards
+        albumName = self.albumDataGroupBox_albumName.text()
+        try:
+            self.runMetrics.writeTrace(os.path.join(albumName, ".downloadinator-trace.json"))
+            self.runMetrics.writePrometheus(os.path.join(albumName, ".downloadinator-metrics.prom"))
+        except OSError as e:
+            print(e)
+
+        if self.failedTracks:
+            self.showFailureSummary()
+
+    def showFailureSummary(self):
+        lines = [
+            f"{track.trackIndex()[0]}. {track.title()} ({classifyError(error)}, {attempts} attempt(s)): {error}"
+            for track, error, attempts in sorted(self.failedTracks, key=lambda failure: failure[0].trackIndex()[0])
+        ]
+        # Not modal, so it doesn't hold anything up if nobody's around
+        self.failureSummary = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Some tracks failed", f"{len(lines)} of {len(self.track_list)} tracks couldn't be downloaded. Downloading the album again will retry just those.", QtWidgets.QMessageBox.Ok, self)
+        self.failureSummary.setDetailedText("\n".join(lines))
+        self.failureSummary.setModal(False)
+        self.failureSummary.show()
+
+    def closeEvent(self, event):
+        # Don't keep the process alive fetching thumbnails nobody will see,
+        # or measuring tracks nobody will tag
+        self.previewLoader.shutdown()
+        self.loudnessAnalyzer.shutdown(wait=False)
+        super(MyWindow, self).closeEvent(event)
+
+    def showTimings(self):
+        TrackTimingsDialog(self, self.runMetrics).exec_()
+
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
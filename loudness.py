@@ -0,0 +1,211 @@
+import importlib.util
+import math
+import os
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# EBU R128 / ITU-R BS.1770 loudness, for ReplayGain 2.0 style track and album
+# gain. NumPy is only needed once analysis is switched on, so it's imported
+# inside the functions that use it.
+
+# ReplayGain 2.0 plays everything back as if it were mastered to this
+reference_loudness = -18.0
+
+analysis_rate = 48000
+analysis_channels = 2
+# Gating blocks are 400 ms long and start every 100 ms
+segment_frames = analysis_rate // 10
+block_segments = 4
+absolute_gate = -70.0
+relative_gate = -10.0
+
+# Decoded audio is read (and filtered) a second at a time
+read_frames = analysis_rate
+
+# Decodes the first audio stream to raw float PCM on stdout, at the rate and
+# channel count the filter coefficients are for
+decoder_command = [
+    "ffmpeg", "-v", "error", "-nostdin", "-i", "{path}",
+    "-map", "0:a:0", "-f", "f32le", "-ac", str(analysis_channels), "-ar", str(analysis_rate), "-",
+]
+
+# BS.1770's K-weighting at 48 kHz: a high shelf for the head's acoustic
+# effect, then a high-pass. Both as (b, a).
+k_weighting_stages = [
+    ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585]),
+    ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621]),
+]
+# The high-pass's impulse response has died away (below -200 dB) well before
+# this, so filtering by FFT convolution with it truncated here is exact for
+# our purposes
+k_weighting_taps = 8192
+
+kernel_cache = {}
+
+
+def kWeightingKernel(size):
+    # rfft of the truncated K-weighting impulse response, zero-padded to `size`
+    import numpy as np
+
+    kernel = kernel_cache.get(size)
+    if kernel is None:
+        kernel = kernel_cache[size] = np.fft.rfft(kWeightingImpulse(), size)
+    return kernel
+
+
+def kWeightingImpulse():
+    # Evaluates the filter's frequency response on a fine grid and transforms
+    # it back, rather than running the recursion sample by sample
+    import numpy as np
+
+    impulse = kernel_cache.get("impulse")
+    if impulse is None:
+        gridSize = 1 << 17
+        z = np.exp(-1j * np.linspace(0, np.pi, gridSize // 2 + 1))
+        response = np.ones_like(z)
+        for b, a in k_weighting_stages:
+            response *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+        impulse = kernel_cache["impulse"] = np.fft.irfft(response, gridSize)[:k_weighting_taps]
+    return impulse
+
+
+def loudness(energy):
+    return -0.691 + 10 * math.log10(energy)
+
+
+def energyAt(loudnessValue):
+    return 10 ** ((loudnessValue + 0.691) / 10)
+
+
+def integratedLoudness(blocks):
+    # Gated mean loudness (LUFS) of an array of block energies; None for
+    # silence
+    blocks = blocks[blocks > energyAt(absolute_gate)]
+    if len(blocks) == 0:
+        return None
+    blocks = blocks[blocks > energyAt(loudness(blocks.mean()) + relative_gate)]
+    return loudness(blocks.mean())
+
+
+class LoudnessMeter:
+    # Streaming K-weighted block energies and sample peak. Fed chunks of
+    # interleaved float samples, shaped (frames, channels).
+    def __init__(self, channels=analysis_channels):
+        import numpy as np
+        self.__np = np
+        # The end of the previous chunk, for overlap-save filtering
+        self.__history = np.zeros((k_weighting_taps - 1, channels), dtype=np.float32)
+        # Summed channel power not yet making up a whole 100 ms segment
+        self.__pending = np.zeros(0)
+        self.__segments = []
+        self.peak = 0.0
+
+    def feed(self, samples):
+        np = self.__np
+        if len(samples) == 0:
+            return
+        self.peak = max(self.peak, float(np.abs(samples).max()))
+
+        signal = np.concatenate([self.__history, samples])
+        self.__history = signal[len(signal) - (k_weighting_taps - 1):]
+        size = 1 << (len(signal) - 1).bit_length()
+        spectrum = np.fft.rfft(signal, size, axis=0) * kWeightingKernel(size)[:, None]
+        weighted = np.fft.irfft(spectrum, size, axis=0)[k_weighting_taps - 1:len(signal)]
+
+        # Left and right both have a channel weight of 1
+        power = np.concatenate([self.__pending, np.einsum("ij,ij->i", weighted, weighted)])
+        whole = len(power) // segment_frames * segment_frames
+        self.__segments.append(power[:whole].reshape(-1, segment_frames).mean(axis=1))
+        self.__pending = power[whole:]
+
+    def blocks(self):
+        # Mean energy of every 400 ms block, overlapping by 75%
+        np = self.__np
+        segments = np.concatenate(self.__segments) if self.__segments else np.zeros(0)
+        if len(segments) < block_segments:
+            return segments[:0]
+        sums = np.concatenate([[0.0], np.cumsum(segments)])
+        return (sums[block_segments:] - sums[:-block_segments]) / block_segments
+
+
+class TrackLoudness:
+    __slots__ = ["blocks", "peak"]
+
+    def __init__(self, blocks, peak):
+        self.blocks = blocks
+        self.peak = peak
+
+    def loudness(self):
+        return integratedLoudness(self.blocks)
+
+
+def analyzeFile(path, command=None):
+    # Runs in the analysis processes: decodes `path` through a pipe and
+    # measures it as it streams in, so the PCM never touches the disk or sits
+    # in memory whole
+    import numpy as np
+
+    frameBytes = 4 * analysis_channels
+    command = [argument.replace("{path}", path) for argument in (command or decoder_command)]
+    meter = LoudnessMeter()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as decoder:
+        while True:
+            data = decoder.stdout.read(read_frames * frameBytes)
+            if not data:
+                break
+            data = data[:len(data) // frameBytes * frameBytes]
+            meter.feed(np.frombuffer(data, dtype="<f4").reshape(-1, analysis_channels))
+        error = decoder.stderr.read()
+    if decoder.returncode != 0:
+        raise RuntimeError(f"Couldn't decode {path} for loudness analysis: {error.decode('utf-8', 'replace').strip()}")
+    return TrackLoudness(meter.blocks(), meter.peak)
+
+
+def albumLoudness(tracks):
+    # Gating runs over every track's blocks together, so an album's loudness
+    # isn't just an average of its tracks'
+    import numpy as np
+    return TrackLoudness(np.concatenate([track.blocks for track in tracks]), max(track.peak for track in tracks))
+
+
+def replayGainTags(track, album):
+    # ReplayGain tag values, for a track's TrackLoudness and its album's
+    tags = {}
+    for prefix, measured in [("track", track), ("album", album)]:
+        value = measured.loudness()
+        if value is None:
+            continue
+        tags[f"replaygain_{prefix}_gain"] = f"{reference_loudness - value:.2f} dB"
+        tags[f"replaygain_{prefix}_peak"] = f"{measured.peak:.6f}"
+    return tags
+
+
+def numpyAvailable():
+    # Without importing it, which would slow down the GUI's startup
+    return importlib.util.find_spec("numpy") is not None
+
+
+class LoudnessAnalyzer:
+    # Decodes and measures tracks in a pool of processes, one per core by
+    # default, so analysis runs alongside the downloads and transcodes
+    # without holding up the post-processing threads
+    def __init__(self, workers=None, command=None):
+        self.__workers = max(1, workers if workers is not None else (os.cpu_count() or 1))
+        self.__command = command
+        self.__pool = None
+        self.__lock = threading.Lock()
+
+    def submit(self, path):
+        # A Future for the track's TrackLoudness
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = ProcessPoolExecutor(self.__workers)
+            return self.__pool.submit(analyzeFile, os.path.abspath(path), self.__command)
+
+    def shutdown(self, wait=True):
+        # Without waiting, analyses that haven't started are cancelled
+        with self.__lock:
+            pool, self.__pool = self.__pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=not wait)
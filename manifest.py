@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+manifest_file_name = ".downloadinator-manifest.json"
+archive_file_name = ".downloadinator-archive.txt"
+
+
+def trackKey(track):
+    # Older configs don't store video IDs, so fall back to the URL
+    return track.trackData().get("id") or track.url()
+
+
+def tagHash(track):
+    artPath = track.albumArtPath()
+    artStat = os.stat(artPath) if artPath and os.path.exists(artPath) else None
+    tags = [
+        track.title(),
+        track.album(),
+        track.artist(),
+        track.year(),
+        track.genre(),
+        list(track.trackIndex()),
+        artPath,
+        [artStat.st_size, artStat.st_mtime_ns] if artStat is not None else None,
+    ]
+    return hashlib.sha1(json.dumps(tags).encode("utf-8")).hexdigest()
+
+
+class AlbumManifest:
+    # Records every finished track in an album's folder, so an interrupted
+    # run can pick up where it left off instead of starting from track 1
+    DOWNLOAD = "download"
+    RETAG = "retag"
+    COMPLETE = "complete"
+
+    def __init__(self, albumDirectory):
+        self.__directory = albumDirectory
+        self.__path = os.path.join(albumDirectory, manifest_file_name)
+        self.__lock = threading.Lock()
+        self.__tracks = {}
+
+        if os.path.exists(self.__path):
+            try:
+                with open(self.__path, "r") as _file:
+                    self.__tracks = json.load(_file).get("tracks", {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {self.__path}: {e}", file=sys.stderr)
+
+    def archivePath(self):
+        return os.path.join(self.__directory, archive_file_name)
+
+    def entry(self, track):
+        with self.__lock:
+            return self.__tracks.get(trackKey(track))
+
+    def trackState(self, track, outputPath):
+        # COMPLETE if the file we wrote is still there and its tags are up to
+        # date, RETAG if only the tags (or the file name) need changing
+        entry = self.entry(track)
+        if entry is None:
+            return AlbumManifest.DOWNLOAD
+
+        previousPath = entry["output_path"]
+        if not os.path.exists(previousPath) or os.path.getsize(previousPath) != entry["size"]:
+            return AlbumManifest.DOWNLOAD
+
+        if previousPath == outputPath and entry["tag_hash"] == tagHash(track):
+            return AlbumManifest.COMPLETE
+        return AlbumManifest.RETAG
+
+    def recordTrack(self, track, outputPath):
+        entry = {
+            "output_path": outputPath,
+            "size": os.path.getsize(outputPath),
+            "tag_hash": tagHash(track),
+            "completed_at": time.time(),
+        }
+        with self.__lock:
+            self.__tracks[trackKey(track)] = entry
+            self.__save()
+
+    def forgetArchived(self, videoId):
+        # youtube_dl won't download anything that's in its archive, so drop
+        # the video from it if its downloaded file has since gone missing
+        with self.__lock:
+            if not os.path.exists(self.archivePath()):
+                return
+            with open(self.archivePath(), "r") as _file:
+                lines = _file.readlines()
+            kept = [line for line in lines if line.split()[-1:] != [videoId]]
+            if len(kept) != len(lines):
+                with open(self.archivePath(), "w") as _file:
+                    _file.writelines(kept)
+
+    def __save(self):
+        # Write to a temporary file first so a crash can't leave a half
+        # written manifest behind
+        temporaryPath = self.__path + ".tmp"
+        with open(temporaryPath, "w") as _file:
+            json.dump({"tracks": self.__tracks}, _file, indent=4)
+        os.replace(temporaryPath, self.__path)
@@ -0,0 +1,122 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def cacheDirectory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "downloadinator")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class PlaylistMetadataCache:
+    # On-disk cache of extracted playlist entries, keyed by playlist URL and
+    # video ID. Entries older than entryTTL are resolved again; a playlist
+    # listing younger than listingTTL is reused without touching the network.
+    def __init__(self, path=None, entryTTL=7 * 24 * 60 * 60, listingTTL=10 * 60, maxPlaylists=200):
+        self.__path = path if path is not None else os.path.join(cacheDirectory(), "metadata.sqlite")
+        self.__entryTTL = entryTTL
+        self.__listingTTL = listingTTL
+        self.__maxPlaylists = maxPlaylists
+        self.__lock = threading.Lock()
+
+        with self.__connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS playlists (
+                url TEXT PRIMARY KEY,
+                video_ids TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+            db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                playlist_url TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (playlist_url, video_id)
+            )""")
+
+    @contextlib.contextmanager
+    def __connect(self):
+        db = sqlite3.connect(self.__path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def freshPlaylist(self, url):
+        # The whole cached playlist in order, if its listing is recent enough
+        # and every entry is still cached; otherwise None
+        now = time.time()
+        with self.__lock, self.__connect() as db:
+            row = db.execute("SELECT video_ids, fetched_at FROM playlists WHERE url = ?", (url,)).fetchone()
+            if row is None or now - row[1] > self.__listingTTL:
+                return None
+
+            videoIds = json.loads(row[0])
+            entries = self.__entriesFor(db, url, now)
+            if any(videoId not in entries for videoId in videoIds):
+                return None
+
+            db.execute("UPDATE playlists SET last_used = ? WHERE url = ?", (now, url))
+            return [entries[videoId] for videoId in videoIds]
+
+    def entries(self, url):
+        # Every unexpired entry cached for this playlist, by video ID
+        with self.__lock, self.__connect() as db:
+            return self.__entriesFor(db, url, time.time())
+
+    def __entriesFor(self, db, url, now):
+        rows = db.execute(
+            "SELECT video_id, data FROM entries WHERE playlist_url = ? AND fetched_at >= ?",
+            (url, now - self.__entryTTL)
+        )
+        return {videoId: json.loads(data) for videoId, data in rows}
+
+    def storePlaylist(self, url, entries, resolvedIds=None):
+        # resolvedIds are the video IDs that were fetched just now; everything
+        # else keeps its original fetch time so it still expires on schedule
+        now = time.time()
+        videoIds = [entry["id"] for entry in entries]
+        with self.__lock, self.__connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO playlists (url, video_ids, fetched_at, last_used) VALUES (?, ?, ?, ?)",
+                (url, json.dumps(videoIds), now, now)
+            )
+            stored = {videoId: json.loads(data) for videoId, data in db.execute("SELECT video_id, data FROM entries WHERE playlist_url = ?", (url,))}
+            for entry in entries:
+                if resolvedIds is None or entry["id"] in resolvedIds:
+                    db.execute(
+                        "INSERT OR REPLACE INTO entries (playlist_url, video_id, data, fetched_at) VALUES (?, ?, ?, ?)",
+                        (url, entry["id"], json.dumps(entry), now)
+                    )
+                elif stored.get(entry["id"]) != entry:
+                    # Reused, but it's moved in the playlist since it was
+                    # stored; the track number comes from its index
+                    db.execute(
+                        "UPDATE entries SET data = ? WHERE playlist_url = ? AND video_id = ?",
+                        (json.dumps(entry), url, entry["id"])
+                    )
+
+            # Drop entries that are no longer in this playlist
+            stillListed = set(videoIds)
+            removed = [(url, videoId) for videoId in stored if videoId not in stillListed]
+            db.executemany("DELETE FROM entries WHERE playlist_url = ? AND video_id = ?", removed)
+            self.__evict(db, now)
+
+    def __evict(self, db, now):
+        db.execute("DELETE FROM entries WHERE fetched_at < ?", (now - self.__entryTTL,))
+        db.execute(
+            "DELETE FROM playlists WHERE url NOT IN (SELECT url FROM playlists ORDER BY last_used DESC LIMIT ?)",
+            (self.__maxPlaylists,)
+        )
+        db.execute("DELETE FROM entries WHERE playlist_url NOT IN (SELECT url FROM playlists)")
+
+    def clear(self):
+        with self.__lock, self.__connect() as db:
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM playlists")
@@ -0,0 +1,179 @@
+import contextlib
+import json
+import threading
+import time
+
+# Stages a track goes through, in order
+track_stages = ["queue_wait", "download", "processing_wait", "transcode", "tagging"]
+
+histogram_buckets = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+class TrackMetrics:
+    __slots__ = ["label", "spans", "openSpans", "bytes"]
+
+    def __init__(self, label):
+        self.label = label
+        self.spans = []
+        self.openSpans = {}
+        self.bytes = {}
+
+    def duration(self, stage):
+        return sum(end - start for name, start, end in self.spans if name == stage)
+
+    def total(self):
+        return sum(end - start for name, start, end in self.spans)
+
+
+class RunMetrics:
+    # Per-track stage timings and byte counts for one run. Spans can start on
+    # one thread and end on another (e.g. queue wait), so everything is keyed
+    # by track rather than kept thread-local.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__startedAt = time.time()
+        self.__origin = time.perf_counter()
+        self.__tracks = {}
+        self.__runSpans = []
+        self.__counters = {}
+
+    def __track(self, key):
+        track = self.__tracks.get(key)
+        if track is None:
+            track = self.__tracks[key] = TrackMetrics(str(key))
+        return track
+
+    def setLabel(self, key, label):
+        with self.__lock:
+            self.__track(key).label = label
+
+    def begin(self, key, stage):
+        now = time.perf_counter()
+        with self.__lock:
+            self.__track(key).openSpans[stage] = now
+
+    def end(self, key, stage):
+        now = time.perf_counter()
+        with self.__lock:
+            track = self.__track(key)
+            start = track.openSpans.pop(stage, None)
+            if start is not None:
+                track.spans.append((stage, start, now))
+
+    @contextlib.contextmanager
+    def span(self, key, stage):
+        self.begin(key, stage)
+        try:
+            yield
+        finally:
+            self.end(key, stage)
+
+    @contextlib.contextmanager
+    def runSpan(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__runSpans.append((stage, start, time.perf_counter()))
+
+    def addBytes(self, key, kind, count):
+        with self.__lock:
+            track = self.__track(key)
+            track.bytes[kind] = track.bytes.get(kind, 0) + count
+
+    def trackCount(self):
+        with self.__lock:
+            return len(self.__tracks)
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def slowestTracks(self):
+        # [(label, total seconds, {stage: seconds}, {kind: bytes})], slowest first
+        with self.__lock:
+            rows = [
+                (track.label, track.total(), { stage: track.duration(stage) for stage in track_stages }, dict(track.bytes))
+                for track in self.__tracks.values()
+            ]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    def trace(self):
+        def spanDict(stage, start, end):
+            return {
+                "stage": stage,
+                "start": round(start - self.__origin, 6),
+                "end": round(end - self.__origin, 6),
+                "seconds": round(end - start, 6),
+            }
+
+        with self.__lock:
+            return {
+                "started_at": self.__startedAt,
+                "run_spans": [spanDict(*span) for span in self.__runSpans],
+                "counters": dict(self.__counters),
+                "tracks": [
+                    {
+                        "track": track.label,
+                        "spans": [spanDict(*span) for span in track.spans],
+                        "bytes": dict(track.bytes),
+                    }
+                    for track in self.__tracks.values()
+                ],
+            }
+
+    def writeTrace(self, path):
+        with open(path, "w") as _file:
+            json.dump(self.trace(), _file, indent=4)
+
+    def prometheus(self, prefix="downloadinator"):
+        # Prometheus text exposition format, e.g. for node_exporter's textfile
+        # collector
+        with self.__lock:
+            durations = {}
+            for track in self.__tracks.values():
+                for stage, start, end in track.spans:
+                    durations.setdefault(stage, []).append(end - start)
+            for stage, start, end in self.__runSpans:
+                durations.setdefault(stage, []).append(end - start)
+
+            byteTotals = {}
+            for track in self.__tracks.values():
+                for kind, count in track.bytes.items():
+                    byteTotals[kind] = byteTotals.get(kind, 0) + count
+
+            counters = dict(self.__counters)
+            trackCount = len(self.__tracks)
+
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent in each stage of an album run.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, values in sorted(durations.items()):
+            for bucket in histogram_buckets:
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {sum(1 for value in values if value <= bucket)}')
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(values)}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {sum(values):.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {len(values)}')
+
+        lines += [
+            f"# HELP {prefix}_bytes_total Bytes handled, by kind.",
+            f"# TYPE {prefix}_bytes_total counter",
+        ]
+        for kind, count in sorted(byteTotals.items()):
+            lines.append(f'{prefix}_bytes_total{{kind="{kind}"}} {count}')
+
+        lines += [
+            f"# HELP {prefix}_tracks_total Tracks seen in this run.",
+            f"# TYPE {prefix}_tracks_total counter",
+            f"{prefix}_tracks_total {trackCount}",
+        ]
+        for name, value in sorted(counters.items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self, path):
+        with open(path, "w") as _file:
+            _file.write(self.prometheus())
@@ -0,0 +1,179 @@
+import collections
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5 import QtCore, QtGui
+
+# Scaled previews kept in memory, least recently used dropped first
+preview_cache_size = 1024
+artwork_preview_height = 128
+
+thumbnail_height = 24
+# YouTube's 320x180 thumbnail, which every video has; worked out from the ID
+# so flat playlist entries don't have to be resolved for it
+thumbnail_url = "https://i.ytimg.com/vi/{id}/mqdefault.jpg"
+thumbnail_workers = 8
+thumbnail_timeout = 10
+
+
+def scaledHeight(image, height):
+    if image.isNull():
+        return None
+    if image.height() != height:
+        image = image.scaledToHeight(height, QtCore.Qt.SmoothTransformation)
+    return image
+
+
+def loadFile(path, height):
+    # Decodes straight to the preview's size where the format allows it
+    # (JPEG does), rather than decoding the whole image and then shrinking it
+    reader = QtGui.QImageReader(path)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and size.height() > height:
+        reader.setScaledSize(QtCore.QSize(max(1, round(size.width() * height / size.height())), height))
+    return scaledHeight(reader.read(), height)
+
+
+def loadThumbnail(videoId, height):
+    import urllib.request
+    with urllib.request.urlopen(thumbnail_url.format(id=videoId), timeout=thumbnail_timeout) as response:
+        data = response.read()
+    return scaledHeight(QtGui.QImage.fromData(data), height)
+
+
+def shutDownExecutors(executors):
+    # Without waiting: whatever's still running finishes on its own, and
+    # nothing queued is started
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PreviewLoader(QtCore.QObject):
+    # Decodes and scales images off the GUI thread. QImage (unlike QPixmap)
+    # is safe to use from other threads, so workers hand back finished
+    # QImages that only need drawing.
+    #
+    # Requests are made on behalf of a "slot" (the artwork picker, a track in
+    # the queue). A newer request for the same slot supersedes the older
+    # one: it's cancelled if it hasn't started, and its result isn't
+    # delivered if it has.
+    previewReady = QtCore.pyqtSignal(object, object)
+    imageLoaded = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None, cacheSize=preview_cache_size):
+        super(PreviewLoader, self).__init__(parent)
+        self.__cacheSize = cacheSize
+        # key -> QImage, or None if it couldn't be loaded
+        self.__cache = collections.OrderedDict()
+        self.__futures = {}
+        self.__waiting = {}
+        self.__latest = {}
+        self.__decoder = ThreadPoolExecutor(max(1, min(4, os.cpu_count() or 1)), thread_name_prefix="PreviewDecoder")
+        self.__fetcher = ThreadPoolExecutor(thumbnail_workers, thread_name_prefix="ThumbnailFetcher")
+        self.__closed = False
+
+        # Exiting waits for the executors' threads, so they're stopped
+        # whichever way the loader goes: the window closing, the application
+        # quitting, or the loader just being deleted
+        application = QtCore.QCoreApplication.instance()
+        if application is not None:
+            application.aboutToQuit.connect(self.shutdown)
+        self.destroyed.connect(functools.partial(shutDownExecutors, [self.__decoder, self.__fetcher]))
+
+        # Workers emit this from their own threads; the slot then runs on the
+        # GUI thread, so everything else here is only touched from there
+        self.imageLoaded.connect(self.__loaded)
+
+    def requestFile(self, slot, path, height=artwork_preview_height):
+        # previewReady(slot, image) follows, straight away if the preview is
+        # cached. image is None if the file isn't a readable image.
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            self.__supersede(slot, None)
+            self.previewReady.emit(slot, None)
+            return
+
+        key = ("file", os.path.abspath(path), stat.st_mtime_ns, stat.st_size, height)
+        if key in self.__cache:
+            self.__supersede(slot, None)
+            self.previewReady.emit(slot, self.__cached(key))
+            return
+        self.__request(slot, key, self.__decoder, loadFile, path, height)
+
+    def thumbnail(self, slot, videoId, height=thumbnail_height):
+        # The cached thumbnail, or None; if it isn't cached yet it's fetched
+        # and previewReady(slot, image) follows
+        if not videoId:
+            return None
+        key = ("thumbnail", videoId, height)
+        if key in self.__cache:
+            return self.__cached(key)
+        if self.__latest.get(slot) != key:
+            self.__request(slot, key, self.__fetcher, loadThumbnail, videoId, height)
+        return None
+
+    def cachedThumbnail(self, videoId, height=thumbnail_height):
+        # The thumbnail if it's already been fetched, without fetching it
+        key = ("thumbnail", videoId, height)
+        return self.__cached(key) if key in self.__cache else None
+
+    def cancel(self, slot):
+        self.__supersede(slot, None)
+
+    def cancelAll(self):
+        for slot in list(self.__latest):
+            self.__supersede(slot, None)
+
+    def shutdown(self):
+        self.cancelAll()
+        self.__closed = True
+        shutDownExecutors([self.__decoder, self.__fetcher])
+
+    def __cached(self, key):
+        self.__cache.move_to_end(key)
+        return self.__cache[key]
+
+    def __request(self, slot, key, executor, load, *args):
+        if self.__closed:
+            return
+        self.__supersede(slot, key)
+        self.__waiting.setdefault(key, set()).add(slot)
+        if key not in self.__futures:
+            self.__futures[key] = executor.submit(self.__load, key, load, *args)
+
+    def __supersede(self, slot, key):
+        previous = self.__latest.pop(slot, None)
+        if key is not None:
+            self.__latest[slot] = key
+        if previous is None or previous == key:
+            return
+
+        waiting = self.__waiting.get(previous)
+        if waiting is not None:
+            waiting.discard(slot)
+            if not waiting:
+                del self.__waiting[previous]
+                future = self.__futures.get(previous)
+                if future is not None and future.cancel():
+                    del self.__futures[previous]
+
+    def __load(self, key, load, *args):
+        try:
+            image = load(*args)
+        except Exception:
+            image = None
+        self.imageLoaded.emit(key, image)
+
+    def __loaded(self, key, image):
+        self.__futures.pop(key, None)
+        self.__cache[key] = image
+        while len(self.__cache) > self.__cacheSize:
+            self.__cache.popitem(last=False)
+
+        for slot in self.__waiting.pop(key, ()):
+            if self.__latest.get(slot) == key:
+                del self.__latest[slot]
+                self.previewReady.emit(slot, image)
@@ -0,0 +1,132 @@
+import collections
+import threading
+import time
+
+
+def formatBytes(count):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(count) < 1024 or unit == "GB":
+            return f"{count:.1f} {unit}" if unit != "B" else f"{int(count)} {unit}"
+        count /= 1024
+
+
+def formatEta(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+    return f"{seconds // 60}:{seconds % 60:02}"
+
+
+class TrackProgress:
+    __slots__ = ["status", "downloadedBytes", "totalBytes", "samples", "finished"]
+
+    def __init__(self):
+        self.status = None
+        self.downloadedBytes = 0
+        self.totalBytes = None
+        self.samples = collections.deque()
+        self.finished = False
+
+    def rate(self):
+        if len(self.samples) < 2:
+            return 0.0
+        (startTime, startBytes), (endTime, endBytes) = self.samples[0], self.samples[-1]
+        if endTime <= startTime:
+            return 0.0
+        return (endBytes - startBytes) / (endTime - startTime)
+
+    def eta(self):
+        rate = self.rate()
+        if self.totalBytes is None or rate <= 0:
+            return None
+        return max(0, self.totalBytes - self.downloadedBytes) / rate
+
+
+class ProgressAggregator:
+    # Collects youtube_dl progress hook events from any thread and keeps only
+    # the latest state per track. Consumers poll drain() at whatever rate
+    # they can afford instead of handling every event.
+    def __init__(self, rateWindow=5.0):
+        self.__rateWindow = rateWindow
+        self.__lock = threading.Lock()
+        self.__tracks = {}
+        self.__dirty = {}
+
+    def addTracks(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__tracks.setdefault(key, TrackProgress())
+
+    def clear(self):
+        with self.__lock:
+            self.__tracks.clear()
+            self.__dirty.clear()
+
+    def report(self, key, d):
+        now = time.monotonic()
+        with self.__lock:
+            track = self.__tracks.setdefault(key, TrackProgress())
+            track.status = d.get("status")
+
+            if "downloaded_bytes" in d:
+                track.downloadedBytes = d["downloaded_bytes"]
+            totalBytes = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if totalBytes:
+                track.totalBytes = totalBytes
+
+            if track.status == "downloading":
+                track.samples.append((now, track.downloadedBytes))
+                while len(track.samples) > 2 and now - track.samples[0][0] > self.__rateWindow:
+                    track.samples.popleft()
+            else:
+                track.samples.clear()
+                if track.status == "finished":
+                    track.finished = True
+                    if track.totalBytes is None:
+                        track.totalBytes = track.downloadedBytes
+
+            self.__dirty[key] = d
+
+    def drain(self):
+        # Returns {key: (latest hook event, bytes/sec, eta seconds)} for every
+        # track that reported since the last drain
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, {}
+            return {
+                key: (d, self.__tracks[key].rate(), self.__tracks[key].eta())
+                for key, d in dirty.items()
+            }
+
+    def downloadedBytes(self, key):
+        with self.__lock:
+            track = self.__tracks.get(key)
+            return track.downloadedBytes if track is not None else 0
+
+    def trackRate(self, key):
+        with self.__lock:
+            track = self.__tracks.get(key)
+            return track.rate() if track is not None else 0.0
+
+    def activeRates(self):
+        # bytes/sec of every track that's downloading right now
+        with self.__lock:
+            return [track.rate() for track in self.__tracks.values() if track.status == "downloading" and len(track.samples) >= 2]
+
+    def overall(self):
+        # Returns (downloaded bytes, estimated total bytes, bytes/sec, eta
+        # seconds). Tracks that haven't started yet are assumed to be the
+        # average size of the ones that have.
+        with self.__lock:
+            downloaded = sum(track.downloadedBytes for track in self.__tracks.values())
+            knownTotals = [track.totalBytes for track in self.__tracks.values() if track.totalBytes]
+            unknownCount = len(self.__tracks) - len(knownTotals)
+            rate = sum(track.rate() for track in self.__tracks.values() if track.status == "downloading")
+
+        if not knownTotals:
+            return (downloaded, None, rate, None)
+
+        total = sum(knownTotals) + unknownCount * (sum(knownTotals) / len(knownTotals))
+        eta = max(0, total - downloaded) / rate if rate > 0 else None
+        return (downloaded, total, rate, eta)
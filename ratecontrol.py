@@ -0,0 +1,139 @@
+import statistics
+import threading
+import time
+
+# Adaptive download concurrency: once every adjust_interval seconds, one more
+# download is allowed if the last one added made things faster, and the
+# number is halved when YouTube pushes back (429s, or streams slowing right
+# down), the way TCP finds a congestion window
+adjust_interval = 10.0
+max_adaptive_downloads = 16
+# Increases that speed things up by less than this count as the link being
+# full; the controller then steps back and waits a while before trying again
+min_improvement = 0.05
+saturated_intervals = 6
+# Per-track speed dropping below this fraction of the best seen so far is
+# treated as throttling
+slow_stream_fraction = 0.3
+# Near the bandwidth cap, slow streams are our own doing
+cap_headroom = 0.9
+
+
+class TokenBucket:
+    # A bandwidth cap shared by every download. consume() blocks the calling
+    # download thread until the bytes it just received fit under the cap, so
+    # the transfer itself slows down (TCP backs off once we stop reading).
+    def __init__(self, rate=None, burst=None):
+        self.__lock = threading.Lock()
+        self.__rate = None
+        self.__burst = None
+        self.__tokens = 0.0
+        self.__updatedAt = time.monotonic()
+        self.setRate(rate, burst)
+
+    def rate(self):
+        return self.__rate
+
+    def setRate(self, rate, burst=None):
+        # rate in bytes per second; None or 0 for no cap. The bucket holds a
+        # second's worth by default, so short bursts aren't smoothed away.
+        with self.__lock:
+            self.__rate = rate or None
+            self.__burst = burst or rate or None
+            self.__tokens = self.__burst or 0.0
+
+    def consume(self, count):
+        with self.__lock:
+            if self.__rate is None:
+                return
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updatedAt) * self.__rate)
+            self.__updatedAt = now
+            # Going into debt and sleeping it off keeps callers in the order
+            # they arrived, rather than having them poll for tokens
+            self.__tokens -= count
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConcurrencyController:
+    # AIMD control of how many downloads run at once. Throttling reports can
+    # come from any thread; tick() should be called regularly from wherever
+    # setLimit may be called (the GUI thread in the GUI).
+    def __init__(self, setLimit, initial, minimum=1, maximum=max_adaptive_downloads, interval=adjust_interval, bandwidth=None):
+        self.__setLimit = setLimit
+        self.__limit = max(minimum, min(maximum, initial))
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.__interval = interval
+        self.__bandwidth = bandwidth
+
+        self.__lock = threading.Lock()
+        self.__throttled = 0
+        self.__samples = []
+        self.__lastAdjust = None
+        self.__lastThroughput = None
+        self.__lastChange = 0
+        self.__holdIntervals = 0
+        self.__bestTrackRate = 0.0
+
+    def setLimit(self, limit):
+        # The user picked a number; carry on from there
+        with self.__lock:
+            if limit == self.__limit:
+                return
+            self.__limit = max(self.__minimum, min(self.__maximum, limit))
+            self.__lastChange = 0
+            self.__lastThroughput = None
+
+    def throttled(self):
+        with self.__lock:
+            self.__throttled += 1
+
+    def tick(self, bytesPerSecond, trackRates, activeCount, now=None):
+        # bytesPerSecond across all downloads, the speeds of the ones running
+        # right now, and how many are running
+        now = time.monotonic() if now is None else now
+        with self.__lock:
+            self.__samples.append(bytesPerSecond)
+            trackRate = statistics.median(trackRates) if trackRates else None
+            if self.__lastAdjust is None:
+                self.__lastAdjust = now
+            if now - self.__lastAdjust < self.__interval:
+                if trackRate is not None and activeCount > 0:
+                    self.__bestTrackRate = max(self.__bestTrackRate, trackRate)
+                return None
+
+            throughput = sum(self.__samples) / len(self.__samples)
+            throttled, self.__throttled = self.__throttled, 0
+            self.__samples = []
+            self.__lastAdjust = now
+
+            capped = self.__bandwidth is not None and self.__bandwidth.rate() is not None and throughput >= cap_headroom * self.__bandwidth.rate()
+            slow = not capped and trackRate is not None and trackRate < slow_stream_fraction * self.__bestTrackRate
+
+            limit = self.__limit
+            if throttled or slow:
+                limit = max(self.__minimum, limit // 2)
+                # Forget how fast streams were before being throttled, or
+                # they'd look slow for good
+                self.__bestTrackRate = trackRate or 0.0
+                self.__holdIntervals = saturated_intervals
+            elif self.__lastChange > 0 and self.__lastThroughput is not None and throughput < self.__lastThroughput * (1 + min_improvement):
+                limit = max(self.__minimum, limit - 1)
+                self.__holdIntervals = saturated_intervals
+            elif self.__holdIntervals > 0:
+                self.__holdIntervals -= 1
+            elif activeCount >= self.__limit and not capped:
+                # Only worth trying more if every slot is actually in use
+                limit = min(self.__maximum, limit + 1)
+
+            self.__lastChange = limit - self.__limit
+            self.__lastThroughput = throughput
+            self.__limit = limit
+            if self.__lastChange == 0:
+                return None
+
+        self.__setLimit(limit)
+        return limit
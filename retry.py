@@ -0,0 +1,94 @@
+import random
+import re
+
+# How often a track's download is tried before it's given up on, and how
+# long to wait between tries. Waits double each time, jittered so tracks
+# that failed together (e.g. on a 429) don't all come back at once.
+download_attempts = 4
+retry_base_delay = 5.0
+retry_max_delay = 300.0
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# Worth trying again: timeouts, throttling, server trouble, and 403s, which
+# YouTube gives for expired stream URLs (a fresh extraction gets a new one)
+transient_http_codes = {403, 408, 425, 429, 500, 502, 503, 504}
+
+transient_messages = re.compile(
+    r"timed out|connection (reset|refused|aborted)|temporary failure in name resolution|"
+    r"too many requests|remote end closed|incomplete ?read|bytes early",
+    re.IGNORECASE,
+)
+http_error_message = re.compile(r"HTTP Error (\d{3})")
+
+
+def errorChain(error):
+    # The error and everything it wraps: youtube_dl's DownloadError keeps
+    # the original exception in exc_info, and ExtractorError in cause,
+    # rather than chaining them
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        exc_info = getattr(error, "exc_info", None)
+        wrapped = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        error = wrapped or getattr(error, "cause", None) or error.__cause__ or error.__context__
+
+
+def classifyError(error):
+    # TRANSIENT if trying again later might work, PERMANENT if it won't
+    # (geo-blocked, private or removed videos, ffmpeg or tagging errors...)
+    import http.client
+    import socket
+    import urllib.error
+
+    chain = list(errorChain(error))
+    for cause in chain:
+        if isinstance(cause, urllib.error.HTTPError):
+            return TRANSIENT if cause.code in transient_http_codes else PERMANENT
+        if isinstance(cause, (socket.timeout, TimeoutError, ConnectionError, urllib.error.URLError, http.client.HTTPException)):
+            return TRANSIENT
+        if type(cause).__name__ == "ContentTooShortError":
+            return TRANSIENT
+    # Otherwise youtube_dl marks errors it expected, such as "Video
+    # unavailable", which are about the video rather than the connection.
+    # (It marks network errors as expected too, hence checking those first.)
+    for cause in chain:
+        if getattr(cause, "expected", False) or type(cause).__name__ == "GeoRestrictedError":
+            return PERMANENT
+
+    message = str(error)
+    match = http_error_message.search(message)
+    if match is not None:
+        return TRANSIENT if int(match.group(1)) in transient_http_codes else PERMANENT
+    if transient_messages.search(message):
+        return TRANSIENT
+    return PERMANENT
+
+
+def isThrottling(error):
+    # Whether YouTube is telling us to back off, as opposed to a one-off
+    # network problem
+    import urllib.error
+
+    for cause in errorChain(error):
+        if isinstance(cause, urllib.error.HTTPError):
+            return cause.code in (403, 429)
+    match = http_error_message.search(str(error))
+    return (match is not None and int(match.group(1)) in (403, 429)) or "too many requests" in str(error).lower()
+
+
+class RetryPolicy:
+    def __init__(self, attempts=download_attempts, baseDelay=retry_base_delay, maxDelay=retry_max_delay):
+        self.attempts = attempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def retryDelay(self, attempt, error):
+        # Seconds to wait before trying again after `attempt` (counting from
+        # 1) failed with `error`, or None to give up
+        if attempt >= self.attempts or classifyError(error) == PERMANENT:
+            return None
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
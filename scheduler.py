@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+
+
+class DownloadScheduler:
+    # Keeps at most maxWorkers jobs in flight, starting them in priority order
+    # (lowest first). Jobs are started through the startJob callback and must
+    # report back with jobFinished() once they're done.
+    def __init__(self, startJob, maxWorkers=3):
+        self.__startJob = startJob
+        self.__maxWorkers = max(1, int(maxWorkers))
+
+        self.__lock = threading.RLock()
+        self.__queue = []
+        self.__entries = {}
+        self.__counter = itertools.count()
+
+        self.__inFlight = set()
+        # Jobs waiting to be retried, which hold neither a slot nor a place
+        # in the queue
+        self.__parked = set()
+        self.__completed = 0
+        self.__total = 0
+        self.__bytesDone = 0
+        self.__startTime = None
+        self.__endTime = None
+        self.__running = False
+
+    def maxWorkers(self):
+        return self.__maxWorkers
+
+    def setMaxWorkers(self, count):
+        with self.__lock:
+            self.__maxWorkers = max(1, int(count))
+        self.__fillSlots()
+
+    def enqueue(self, job, priority=0):
+        with self.__lock:
+            self.__total += 1
+            self.__push(job, priority)
+        self.__fillSlots()
+
+    def setPriority(self, job, priority):
+        with self.__lock:
+            if job not in self.__entries:
+                return False
+            self.__entries[job][-1] = None
+            self.__push(job, priority)
+            return True
+
+    def inFlightCount(self):
+        with self.__lock:
+            return len(self.__inFlight)
+
+    def completedCount(self):
+        return self.__completed
+
+    def totalCount(self):
+        return self.__total
+
+    def isRunning(self):
+        return self.__running
+
+    def start(self):
+        with self.__lock:
+            if self.__running:
+                return
+            self.__running = True
+            self.__startTime = time.monotonic()
+            self.__endTime = None
+            if not self.__entries and not self.__inFlight and not self.__parked:
+                self.__running = False
+                self.__endTime = self.__startTime
+                return
+
+        self.__fillSlots()
+
+    def addBytes(self, count):
+        with self.__lock:
+            self.__bytesDone += count
+
+    def jobFinished(self, job):
+        with self.__lock:
+            if job not in self.__inFlight:
+                return
+            self.__inFlight.discard(job)
+            self.__completed += 1
+            if not self.__entries and not self.__inFlight and not self.__parked:
+                self.__running = False
+                self.__endTime = time.monotonic()
+                return
+
+        self.__fillSlots()
+
+    def park(self, job):
+        # Frees an in-flight job's slot without counting it as done, so
+        # other jobs can go ahead while it waits to be retried with unpark()
+        with self.__lock:
+            if job not in self.__inFlight:
+                return
+            self.__inFlight.discard(job)
+            self.__parked.add(job)
+        self.__fillSlots()
+
+    def unpark(self, job, priority=0):
+        with self.__lock:
+            if job not in self.__parked:
+                return
+            self.__parked.discard(job)
+            self.__push(job, priority)
+        self.__fillSlots()
+
+    def elapsed(self):
+        if self.__startTime is None:
+            return 0.0
+        end = self.__endTime if self.__endTime is not None else time.monotonic()
+        return end - self.__startTime
+
+    def throughput(self):
+        # Returns (tracks per minute, bytes per second) since start()
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return (0.0, 0.0)
+        return (self.__completed * 60.0 / elapsed, self.__bytesDone / elapsed)
+
+    def __push(self, job, priority):
+        entry = [priority, next(self.__counter), job]
+        self.__entries[job] = entry
+        heapq.heappush(self.__queue, entry)
+
+    def __popNext(self):
+        while self.__queue:
+            priority, _, job = heapq.heappop(self.__queue)
+            if job is not None:
+                del self.__entries[job]
+                return job
+        return None
+
+    def __fillSlots(self):
+        toStart = []
+        with self.__lock:
+            if not self.__running:
+                return
+            while len(self.__inFlight) < self.__maxWorkers:
+                job = self.__popNext()
+                if job is None:
+                    break
+                self.__inFlight.add(job)
+                toStart.append(job)
+
+        for job in toStart:
+            self.__startJob(job)
+
+
+class PostProcessingStage:
+    # A fixed pool of worker threads fed through a bounded queue. submit()
+    # blocks while the queue is full, so a download slot that's finished its
+    # network work stays occupied until there's room to hand the track over.
+    def __init__(self, process, workers=None, maxQueued=None):
+        self.__process = process
+        self.__workerCount = max(1, workers if workers is not None else (os.cpu_count() or 1))
+        self.__queue = queue.Queue(maxQueued if maxQueued is not None else self.__workerCount)
+        self.__workers = []
+
+        for i in range(self.__workerCount):
+            worker = threading.Thread(target=self.__work, name=f"PostProcessing-{i}", daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def workerCount(self):
+        return self.__workerCount
+
+    def submit(self, job):
+        self.__queue.put(job)
+
+    def shutdown(self, wait=True):
+        for _ in self.__workers:
+            self.__queue.put(None)
+        if wait:
+            for worker in self.__workers:
+                worker.join()
+        self.__workers = []
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is None:
+                    return
+                self.__process(job)
+            except Exception as e:
+                print(e)
+            finally:
+                self.__queue.task_done()
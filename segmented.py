@@ -0,0 +1,122 @@
+import contextlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Long tracks (hour-long soundtrack compilations) are throttled per
+# connection, so anything at least this big is fetched as several byte ranges
+# at once and reassembled in place
+segmented_threshold_bytes = 32 * 1024 * 1024
+default_connections = 4
+min_segment_bytes = 4 * 1024 * 1024
+chunk_bytes = 256 * 1024
+request_timeout = 30
+# Not youtube_dl's ".part": a single-stream download resuming from this
+# preallocated (mostly zero) file would take it as already downloaded
+partial_suffix = ".segments"
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def segmentRanges(totalBytes, connections, minSegmentBytes=min_segment_bytes):
+    # Inclusive (first, last) byte ranges covering the whole file
+    count = max(1, min(connections, totalBytes // max(1, minSegmentBytes)))
+    size = -(-totalBytes // count)
+    return [(first, min(first + size, totalBytes) - 1) for first in range(0, totalBytes, size)]
+
+
+def canSegment(info, connections, threshold=None):
+    # Whether youtube_dl's chosen format is a plain HTTP(S) file big enough
+    # to be worth splitting
+    if connections < 2 or info.get("requested_formats"):
+        return False
+    if (info.get("protocol") or info.get("url", "").partition(":")[0]) not in ("http", "https"):
+        return False
+    # An approximate size would give wrong ranges
+    return (info.get("filesize") or 0) >= (threshold if threshold is not None else segmented_threshold_bytes)
+
+
+class SegmentedDownload:
+    def __init__(self, url, path, totalBytes, connections=default_connections, headers=None, progressHook=None):
+        self.url = url
+        self.path = path
+        self.totalBytes = totalBytes
+        self.connections = connections
+        self.headers = dict(headers or {})
+        self.progressHook = progressHook
+
+        self.__downloaded = 0
+        self.__lock = threading.Lock()
+
+    def run(self):
+        # Raises RangeNotSupported if the server ignores Range requests, in
+        # which case nothing has been written yet
+        ranges = segmentRanges(self.totalBytes, self.connections)
+        partPath = self.path + partial_suffix
+
+        # Check the server honours ranges before touching the disk, with the
+        # first segment's request so it isn't wasted
+        firstResponse = self.__open(*ranges[0])
+
+        try:
+            with open(partPath, "wb") as _file:
+                _file.truncate(self.totalBytes)
+
+            with ThreadPoolExecutor(len(ranges)) as pool:
+                futures = [pool.submit(self.__fetch, ranges[0], firstResponse)]
+                futures += [pool.submit(self.__fetch, byteRange) for byteRange in ranges[1:]]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            # Segments are fetched whole or not at all, so there's nothing
+            # worth keeping for the next attempt
+            firstResponse.close()
+            with contextlib.suppress(OSError):
+                os.remove(partPath)
+            raise
+
+        os.replace(partPath, self.path)
+        self.__report("finished")
+
+    def __open(self, first, last):
+        import urllib.request
+        request = urllib.request.Request(self.url, headers=self.headers | {"Range": f"bytes={first}-{last}"})
+        response = urllib.request.urlopen(request, timeout=request_timeout)
+        contentRange = response.headers.get("Content-Range", "")
+        if response.status != 206 or not contentRange.startswith(f"bytes {first}-"):
+            response.close()
+            raise RangeNotSupported(f"{self.url} ignored a Range request (HTTP {response.status})")
+        return response
+
+    def __fetch(self, byteRange, response=None):
+        first, last = byteRange
+        if response is None:
+            response = self.__open(first, last)
+
+        # Each segment writes through its own handle, at its own offset
+        position = first
+        with response, open(self.path + partial_suffix, "r+b") as _file:
+            _file.seek(first)
+            while position <= last:
+                chunk = response.read(min(chunk_bytes, last - position + 1))
+                if not chunk:
+                    raise ConnectionError(f"connection closed {last - position + 1} bytes early")
+                _file.write(chunk)
+                position += len(chunk)
+                self.__progress(len(chunk))
+
+    def __progress(self, count):
+        with self.__lock:
+            self.__downloaded += count
+        self.__report("downloading")
+
+    def __report(self, status):
+        if self.progressHook is not None:
+            self.progressHook({
+                "status": status,
+                "downloaded_bytes": self.__downloaded,
+                "total_bytes": self.totalBytes,
+                "filename": self.path,
+            })
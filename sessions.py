@@ -0,0 +1,57 @@
+import contextlib
+import threading
+
+# Options every pooled session is created with; each checkout layers its own
+# (outtmpl, format, progress hooks, ...) on top for the length of one job
+session_options = {
+    'prefer_ffmpeg': True,
+    'quiet': True,
+}
+
+
+class YoutubeDLPool:
+    # Long-lived YoutubeDL instances shared by the tracks of a run, so the
+    # extractors' caches (e.g. YouTube's deciphered player JS), cookies and
+    # URL opener carry over from one track to the next instead of being
+    # rebuilt per track. YoutubeDL isn't thread-safe, so a session is only
+    # ever checked out by one job at a time; the pool grows to however many
+    # jobs run at once.
+    def __init__(self, baseOptions=None):
+        self.__baseOptions = dict(session_options if baseOptions is None else baseOptions)
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self, options=None):
+        options = dict(options or {})
+        progressHooks = options.pop('progress_hooks', [])
+
+        ydl, baseParams = self.__checkOut()
+        ydl.params.update(options)
+        ydl._progress_hooks = list(progressHooks)
+        try:
+            yield ydl
+        finally:
+            # Nothing from this job should leak into the next one
+            ydl.params.clear()
+            ydl.params.update(baseParams)
+            ydl._progress_hooks = []
+            with self.__lock:
+                self.__idle.append((ydl, baseParams))
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for ydl, _ in idle:
+            ydl.__exit__(None, None, None)
+
+    def __checkOut(self):
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+
+        # Imported here so creating a pool doesn't pay for youtube_dl's
+        # extractor tables; the first session does
+        import youtube_dl
+        ydl = youtube_dl.YoutubeDL(dict(self.__baseOptions))
+        return ydl, dict(ydl.params)
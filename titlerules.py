@@ -0,0 +1,75 @@
+import functools
+import re
+
+# Title rules, one per line:
+#
+#   s/\s*\[OST\]//          a substitution, applied to the title in order
+#   ^\d+\.?\s*-?\s*(.*)$    a match rule; the first one that matches picks the
+#                           title from its "title" group, or group 1, or the
+#                           whole match
+#
+# If no match rule matches, the title is whatever the substitutions left.
+# Lines starting with # are ignored.
+
+
+class TitleRule:
+    def __init__(self, source):
+        self.source = source
+        self.replacement = None
+
+        substitution = re.fullmatch(r"s/((?:\\.|[^/\\])*)/((?:\\.|[^/\\])*)/?", source)
+        if substitution is not None:
+            self.pattern = re.compile(substitution.group(1).replace("\\/", "/"))
+            self.replacement = substitution.group(2).replace("\\/", "/")
+        else:
+            self.pattern = re.compile(source)
+
+    def isSubstitution(self):
+        return self.replacement is not None
+
+    def extract(self, title):
+        regexMatches = self.pattern.match(title)
+        if regexMatches is None:
+            return None
+        if "title" in self.pattern.groupindex:
+            return regexMatches.group("title")
+        if self.pattern.groups > 0:
+            return regexMatches.group(1)
+        return regexMatches.group(0)
+
+
+class TitleRuleSet:
+    def __init__(self, rules):
+        self.rules = tuple(TitleRule(rule) for rule in rules)
+        self.__titles = {}
+
+    def apply(self, rawName):
+        title = self.__titles.get(rawName)
+        if title is None:
+            title = self.__titles[rawName] = self.__apply(rawName)
+        return title
+
+    def applyAll(self, rawNames):
+        return [self.apply(rawName) for rawName in rawNames]
+
+    def __apply(self, rawName):
+        title = rawName
+        for rule in self.rules:
+            if rule.isSubstitution():
+                title = rule.pattern.sub(rule.replacement, title)
+            else:
+                extracted = rule.extract(title)
+                if extracted is not None:
+                    return extracted.strip()
+        return title.strip()
+
+
+def parseRules(text):
+    return tuple(line for line in (line.strip() for line in text.splitlines()) if line and not line.startswith("#"))
+
+
+@functools.lru_cache(maxsize=16)
+def compileRules(text):
+    # The same rule text always gives back the same compiled (and memoized)
+    # rule set. Raises re.error if a rule isn't a valid regex.
+    return TitleRuleSet(parseRules(text))
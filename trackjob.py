@@ -0,0 +1,470 @@
+import contextlib
+import os
+import sys
+import threading
+from datetime import timedelta
+
+# youtube_dl and mutagen are slow to import, so they're only imported once a
+# track actually needs them, keeping the GUI's startup quick
+
+import artwork
+from manifest import AlbumManifest
+from loudness import albumLoudness, replayGainTags
+from segmented import SegmentedDownload, RangeNotSupported, canSegment, default_connections
+from titlerules import compileRules
+
+# YouTube usually has an AAC stream alongside the Opus one; when it's what we
+# downloaded, it only needs (at most) moving into an .m4a container
+aac_codecs = ("mp4a", "aac")
+m4a_containers = ("m4a",)
+stream_copy_format = 'bestaudio[acodec^=mp4a]/bestaudio/best'
+
+# Room left after the tags when mutagen has to grow them anyway, so that
+# re-tagging later (e.g. after a title change) can rewrite them in place
+# instead of shifting the whole file
+tag_padding_bytes = 64 * 1024
+
+freeform_tag_prefix = "----:com.apple.iTunes:"
+replaygain_tag_prefix = freeform_tag_prefix + "replaygain_"
+
+KEEP = "keep"
+REMUX = "remux"
+TRANSCODE = "transcode"
+
+
+def tagPadding(info):
+    # mutagen padding callback: keep whatever's there if the tags still fit,
+    # otherwise reserve some room for next time
+    if info.padding >= 0:
+        return info.padding
+    return tag_padding_bytes
+
+
+def writeAlbumGain(jobs):
+    # Once all of an album's tracks are done: album gain is measured over the
+    # whole album, so it can only be tagged now. Tracks that weren't
+    # processed in this run are measured here too.
+    for job in jobs:
+        if job.loudnessResult is None and os.path.exists(job.outputPath("m4a")):
+            job.analyzeLoudness()
+
+    measured = []
+    for job in jobs:
+        if job.loudnessResult is None:
+            continue
+        try:
+            measured.append((job, job.loudnessResult.result()))
+        except Exception as e:
+            print(f"Leaving {job.track.title()} out of the album's loudness: {e}", file=sys.stderr)
+    if not measured:
+        return
+
+    album = albumLoudness([result for _, result in measured])
+    for job, result in measured:
+        job.setReplayGain(replayGainTags(result, album))
+        # The tags usually fit in the padding, but the size may have changed
+        if job.manifest is not None:
+            job.manifest.recordTrack(job.track, job.outputPath("m4a"))
+
+
+def audioConversion(info):
+    # What it takes to turn a downloaded format into our .m4a output
+    codec = (info.get("acodec") or "").lower()
+    if not codec.startswith(aac_codecs):
+        return TRANSCODE
+    # YouTube's m4a formats are fragmented DASH, which plenty of players
+    # can't seek in (or play at all); youtube_dl remuxes them after a normal
+    # download, but segmented downloads skip that, so it's done here for both
+    if info.get("ext") in m4a_containers and info.get("container") != "m4a_dash":
+        return KEEP
+    return REMUX
+
+
+class AlbumTrack:
+    # Plain counterpart to the GUI's TrackItem, for running jobs without Qt
+    def __init__(self, trackData, trackIndex, album, artist, year, albumArtPath, titlePattern=None, genre="Soundtrack"):
+        self.__trackData = trackData
+        self.__rawName = trackData["title"]
+        self.__trackTitle = trackData["title"]
+        if titlePattern:
+            self.__trackTitle = compileRules(titlePattern).apply(self.__rawName)
+        self.__trackIndex = trackIndex
+        self.__trackAlbum = album
+        self.__trackArtist = artist
+        self.__trackYear = year
+        self.__trackGenre = genre
+        self.__albumArtPath = albumArtPath
+
+    def title(self):
+        return self.__trackTitle
+
+    def artist(self):
+        return self.__trackArtist
+
+    def album(self):
+        return self.__trackAlbum
+
+    def year(self):
+        return self.__trackYear
+
+    def albumArtPath(self):
+        return self.__albumArtPath
+
+    def genre(self):
+        return self.__trackGenre
+
+    def rawName(self):
+        return self.__rawName
+
+    def duration(self):
+        return self.__trackData["duration"]
+
+    def readableDuration(self):
+        return timedelta(seconds=self.duration())
+
+    def trackIndex(self):
+        return self.__trackIndex
+
+    def url(self):
+        return self.__trackData["webpage_url"]
+
+    def trackData(self):
+        return self.__trackData
+
+
+class TrackJob:
+    # Downloads, transcodes and tags a single track. `track` can be anything
+    # with TrackItem's accessors. There's no Qt in here: the GUI runs jobs
+    # from TrackDownloaderThread, and batch.py runs them directly.
+    def __init__(self, track, progressHook=None, onStartingProcessing=None, manifest=None, metrics=None, preferStreamCopy=False, artworkCache=None, sessions=None, connections=default_connections, audioCache=None, loudness=None, bandwidth=None):
+        self.track = track
+        self.progressHook = progressHook
+        self.onStartingProcessing = onStartingProcessing
+        self.manifest = manifest
+        self.metrics = metrics
+        self.preferStreamCopy = preferStreamCopy
+        self.artworkCache = artworkCache if artworkCache is not None else artwork.shared_cache
+        self.sessions = sessions
+        self.connections = connections
+        self.audioCache = audioCache
+        self.loudness = loudness
+        self.loudnessResult = None
+        # A ratecontrol.TokenBucket shared with the other downloads, if
+        # there's a bandwidth cap
+        self.bandwidth = bandwidth
+        self.__reportedBytes = None
+        self.__reportLock = threading.Lock()
+        self.retagOnly = False
+        self.fromCache = False
+        self.downloadedInfo = None
+        self.attempts = 0
+
+    def outputPath(self, extension):
+        return f"{self.track.album()}/{self.track.title()}.{extension}"
+
+    def span(self, stage):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.span(self.track, stage)
+
+    def beginStage(self, stage):
+        if self.metrics is not None:
+            self.metrics.begin(self.track, stage)
+
+    def endStage(self, stage):
+        if self.metrics is not None:
+            self.metrics.end(self.track, stage)
+
+    def addBytes(self, kind, count):
+        if self.metrics is not None:
+            self.metrics.addBytes(self.track, kind, count)
+
+    def session(self, options):
+        # A YoutubeDL with `options`, from the pool if the job was given one
+        if self.sessions is None:
+            import youtube_dl
+            return youtube_dl.YoutubeDL(options)
+        return self.sessions.session(options)
+
+    def coverArt(self):
+        if self.track.albumArtPath() == "":
+            return None
+        return self.artworkCache.cover(self.track.albumArtPath())
+
+    def updateProgress(self, d):
+        # Called on the thread doing the downloading (one per segment for
+        # segmented downloads), so waiting for bandwidth here slows it down
+        if self.bandwidth is not None and d.get("status") == "downloading":
+            with self.__reportLock:
+                downloadedBytes = d.get("downloaded_bytes", 0)
+                # The first report may include bytes from an earlier,
+                # resumed attempt
+                received = downloadedBytes - self.__reportedBytes if self.__reportedBytes is not None else 0
+                self.__reportedBytes = downloadedBytes
+            if received > 0:
+                self.bandwidth.consume(received)
+        if self.progressHook is not None:
+            self.progressHook(d)
+
+    def resumeState(self):
+        # Checks the album manifest to see how much of this track is left to
+        # do. Tracks that only need new tags skip the download stage.
+        if self.manifest is None:
+            return AlbumManifest.DOWNLOAD
+        state = self.manifest.trackState(self.track, self.outputPath("m4a"))
+        self.retagOnly = state == AlbumManifest.RETAG
+        return state
+
+    def cacheKey(self):
+        # The same video can come out differently depending on the format
+        # we asked youtube_dl for
+        videoId = self.track.trackData().get("id")
+        if videoId is None:
+            return None
+        return f"{videoId}:{'aac' if self.preferStreamCopy else 'best'}"
+
+    def download(self):
+        self.endStage("queue_wait")
+        self.attempts += 1
+        self.fromCache = False
+        self.downloadedInfo = None
+        self.__reportedBytes = None
+        if not self.retagOnly and not self.fetchFromCache():
+            with self.span("download"):
+                self.fetch()
+            self.addBytes("downloaded", os.path.getsize(self.downloadedInfo['filepath']))
+        self.beginStage("processing_wait")
+
+    def fetchFromCache(self):
+        # Another album (or an earlier run) may already have this video; if
+        # so it only needs this album's tags
+        if self.audioCache is None or self.cacheKey() is None:
+            return False
+        os.makedirs(self.track.album(), exist_ok=True)
+        self.fromCache = self.audioCache.fetch(self.cacheKey(), self.outputPath("m4a"))
+        if self.metrics is not None:
+            self.metrics.count("audio_cache_hits" if self.fromCache else "audio_cache_misses")
+        return self.fromCache
+
+    def fetch(self):
+        os.makedirs(self.track.album(), exist_ok=True)
+
+        download_options = {
+            'format': stream_copy_format if self.preferStreamCopy else 'bestaudio/best',
+            'outtmpl': self.track.album() + "/" + self.track.title().replace('/', '\\/').replace('%', '%%') + ".%(ext)s",
+            'prefer_ffmpeg': True,
+            'continuedl': True,
+            'quiet': True,
+            'progress_hooks': [self.updateProgress],
+            # audioConversion remuxes DASH m4a itself, for segmented
+            # downloads too; youtube_dl doing it as well would copy it twice
+            'fixup': 'never',
+        }
+        if self.manifest is not None:
+            download_options['download_archive'] = self.manifest.archivePath()
+
+        with self.session(download_options) as ydl:
+            self.downloadedInfo = self.fetchWith(ydl)
+
+            # youtube_dl skips anything in its archive, even if we never got
+            # as far as finishing the track; forget it and try again
+            if not os.path.exists(self.downloadedInfo['filepath']) and self.manifest is not None:
+                self.manifest.forgetArchived(self.downloadedInfo['id'])
+                self.downloadedInfo = self.fetchWith(ydl)
+
+    def fetchWith(self, ydl):
+        # Resolve the format first, so big files can be fetched over several
+        # connections instead of youtube_dl's single stream
+        info = ydl.extract_info(self.track.url(), download=False)
+        info['filepath'] = ydl.prepare_filename(info)
+
+        if canSegment(info, self.connections) and not ydl.in_download_archive(info):
+            if os.path.exists(info['filepath']) and os.path.getsize(info['filepath']) == info.get('filesize'):
+                return info
+            try:
+                SegmentedDownload(
+                    info['url'],
+                    info['filepath'],
+                    info['filesize'],
+                    self.connections,
+                    info.get('http_headers'),
+                    self.updateProgress,
+                ).run()
+            except RangeNotSupported:
+                pass
+            else:
+                ydl.record_download_archive(info)
+                return info
+
+        ydl.process_info(info)
+        return info
+
+    def postProcess(self):
+        self.endStage("processing_wait")
+        if self.onStartingProcessing is not None:
+            self.onStartingProcessing()
+
+        if self.retagOnly:
+            # Already downloaded and transcoded; it may just need renaming
+            # if the title pattern changed
+            previousPath = self.manifest.entry(self.track)["output_path"]
+            if previousPath != self.outputPath("m4a"):
+                os.replace(previousPath, self.outputPath("m4a"))
+            tagged = False
+        elif self.fromCache:
+            tagged = False
+        else:
+            with self.span("transcode"):
+                tagged = self.extractAudio()
+        if not tagged:
+            with self.span("tagging"):
+                self.setM4AMetadata()
+        self.addBytes("written", os.path.getsize(self.outputPath("m4a")))
+
+        if self.audioCache is not None and not self.retagOnly and not self.fromCache and self.cacheKey() is not None:
+            self.audioCache.store(self.cacheKey(), self.outputPath("m4a"))
+
+        if self.manifest is not None:
+            self.manifest.recordTrack(self.track, self.outputPath("m4a"))
+
+        self.analyzeLoudness()
+
+    def analyzeLoudness(self):
+        # Measured in the analyzer's processes while this thread moves on to
+        # the next track; writeAlbumGain collects the result
+        if self.loudness is not None:
+            self.loudnessResult = self.loudness.submit(self.outputPath("m4a"))
+
+    def extractAudio(self):
+        # Returns True if the output was tagged while it was being written
+        conversion = audioConversion(self.downloadedInfo)
+        if self.metrics is not None:
+            self.metrics.count(f"audio_{conversion}")
+
+        path = self.downloadedInfo['filepath']
+        if conversion == KEEP:
+            if path != self.outputPath("m4a"):
+                os.replace(path, self.outputPath("m4a"))
+            self.downloadedInfo['filepath'] = self.outputPath("m4a")
+            return False
+
+        # ffmpeg can't write over its own input (e.g. ALAC in an .m4a)
+        outputPath = self.outputPath("m4a")
+        if path == outputPath:
+            outputPath = self.outputPath("encoding.m4a")
+
+        audioOptions = ['-map', '0:a:0']
+        if conversion == REMUX:
+            # Already AAC, so copy the stream rather than re-encoding it. We
+            # trust the format's metadata here instead of asking ffprobe,
+            # which FFmpegExtractAudioPP would do.
+            audioOptions += ['-c:a', 'copy']
+        else:
+            audioOptions += ['-c:a', 'aac', '-b:a', '320k']
+        audioOptions += ['-bsf:a', 'aac_adtstoasc'] + self.ffmpegMetadataOptions()
+
+        post_processing_options = {
+            'prefer_ffmpeg': True,
+            'quiet': True,
+        }
+
+        from youtube_dl.postprocessor import FFmpegPostProcessor
+        cover = self.coverArt()
+        with self.session(post_processing_options) as ydl:
+            ffmpeg = FFmpegPostProcessor(ydl)
+            if cover is None:
+                ffmpeg.run_ffmpeg_multiple_files([path], outputPath, audioOptions)
+                coverTagged = True
+            else:
+                try:
+                    ffmpeg.run_ffmpeg_multiple_files([path, cover.path], outputPath, audioOptions + ['-map', '1:0', '-c:v', 'copy', '-disposition:v:0', 'attached_pic'])
+                    coverTagged = True
+                except Exception:
+                    # Older ffmpeg builds won't put a cover stream in an
+                    # .m4a; write the audio alone and let setM4AMetadata add
+                    # the cover instead
+                    ffmpeg.run_ffmpeg_multiple_files([path], outputPath, audioOptions)
+                    coverTagged = False
+
+        os.replace(outputPath, self.outputPath("m4a"))
+        if path != self.outputPath("m4a") and os.path.exists(path):
+            os.remove(path)
+        self.downloadedInfo['filepath'] = self.outputPath("m4a")
+        self.downloadedInfo['ext'] = "m4a"
+        return coverTagged
+
+    def ffmpegMetadataOptions(self):
+        # The same tags setM4AMetadata writes, as ffmpeg -metadata options
+        index, count = self.track.trackIndex()
+        metadata = {
+            'title': self.track.title(),
+            'album': self.track.album(),
+            'artist': self.track.artist(),
+            'album_artist': self.track.artist(),
+            'composer': self.track.artist(),
+            'date': self.track.year(),
+            'track': f"{index}/{count}",
+        }
+        options = []
+        for key, value in metadata.items():
+            options += ['-metadata', f"{key}={value}"]
+        return options
+
+    def setM4AMetadata(self):
+        from mutagen.mp4 import MP4, MP4Cover
+        audio = MP4(self.outputPath("m4a"))
+        if audio.tags is None:
+            audio.add_tags()
+        tags = audio.tags
+        tags['\xa9nam'] = self.track.title()
+        tags['\xa9alb'] = self.track.album()
+        tags['\xa9ART'] = self.track.artist()
+        tags['aART'] = self.track.artist()
+        tags['\xa9wrt'] = self.track.artist()
+        tags['\xa9day'] = self.track.year()
+        tags['trkn'] = [self.track.trackIndex()]
+        # Gain measured for another album (or before the tracks changed) is
+        # wrong here; writeAlbumGain adds this album's
+        for key in [key for key in tags.keys() if key.startswith(replaygain_tag_prefix)]:
+            del tags[key]
+
+        cover = self.coverArt()
+        if cover is not None:
+            tags['covr'] = [MP4Cover(cover.data, MP4Cover.FORMAT_JPEG if cover.format == "jpeg" else MP4Cover.FORMAT_PNG)]
+        else:
+            # Audio from the cache may still have another album's cover
+            tags.pop('covr', None)
+
+        audio.save(padding=tagPadding)
+
+    def setReplayGain(self, tags):
+        from mutagen.mp4 import MP4, MP4FreeForm
+        audio = MP4(self.outputPath("m4a"))
+        if audio.tags is None:
+            audio.add_tags()
+        for name, value in tags.items():
+            audio.tags[freeform_tag_prefix + name] = [MP4FreeForm(value.encode("utf-8"))]
+        audio.save(padding=tagPadding)
+
+    def setMP3Metadata(self):
+        from mutagen.id3 import ID3, TPE1, TPE2, TALB, APIC, TYER, TCON, TRCK
+        mp3_file = ID3(self.outputPath("mp3"))
+        mp3_file['TPE1'] = TPE1(encoding=3, text=self.track.artist())
+        mp3_file['TPE2'] = TPE2(encoding=3, text=self.track.artist())
+        mp3_file['TPE3'] = TPE2(encoding=3, text=self.track.artist())
+        mp3_file['TALB'] = TALB(encoding=3, text=self.track.album())
+        mp3_file['TYER'] = TYER(encoding=3, text=self.track.year())
+        mp3_file['TCON'] = TCON(encoding=3, text=self.track.genre())
+
+        if self.track.trackIndex() != (0,0):
+            mp3_file["TRCK"] = TRCK(encoding=3, text=f"{self.track.trackIndex()[0]}/{self.track.trackIndex()[1]}")
+
+        cover = self.coverArt()
+        if cover is not None:
+            mp3_file['APIC'] = APIC(
+                        encoding=3,
+                        mime=cover.mime(),
+                        type=3, desc=u'Cover',
+                        data=cover.data
+                        )
+        mp3_file.save(padding=tagPadding)